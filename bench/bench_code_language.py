@@ -0,0 +1,114 @@
+# Checks CodeClassifier against the regex by regex detection it replaced in
+# write_code on the code blocks of the converted DevGuide, then compares how
+# long they take to classify all of them.
+#
+#   python bench/bench_code_language.py [--repeat N]
+
+import sys
+import re
+import argparse
+import time
+from pathlib import Path
+
+repo_path = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(repo_path))
+
+import code_language
+
+
+# Old Implementation ==========================================================
+
+legacy_code_regex = {
+  'omg-idl': re.compile(r'@key|@topic|module DDS|interface|enum|boolean|struct'),
+  'ini': re.compile('\[common]|\[transport|\[domain|\[config'),
+  'xml': re.compile('xml version="1.0"'),
+  'cpp': re.compile('int main|#include.*\.h[">]|int ACE_TMAIN|_var |OpenDDS::DCPS::|std::|\w->'),
+  'java': re.compile('public static void main|System.out.println|Helper|null'),
+  'bash': re.compile('\$(ACE|DDS)'),
+  'doscon': re.compile('\%(ACE|DDS)'),
+  'mpc': re.compile('project[\(:]'),
+}
+
+
+def legacy_names(code):
+  names = []
+  for name, regex in legacy_code_regex.items():
+    if regex.search(code):
+      names.append(name)
+  return names
+
+
+# Code Blocks =================================================================
+
+directive_re = re.compile(r'^(?:\.\. code-block:: (\S+)|::)$')
+
+
+def get_code_blocks():
+  # Returns (language, code) for each code block in devguide/*.rst
+  blocks = []
+  for path in sorted((repo_path / 'devguide').glob('*.rst')):
+    lines = path.read_text().split('\n')
+    i = 0
+    while i < len(lines):
+      m = directive_re.match(lines[i])
+      i += 1
+      if not m:
+        continue
+      i += 1 # Blank line after the directive
+      code = []
+      while i < len(lines) and (lines[i].startswith('   ') or not lines[i]):
+        code.append(lines[i][3:])
+        i += 1
+      while code and not code[-1]:
+        code.pop()
+      blocks.append((m.group(1), '\n'.join(code)))
+  return blocks
+
+
+# Benchmark ===================================================================
+
+def check(blocks):
+  classifier = code_language.CodeClassifier()
+  differ = 0
+  for language, code in blocks:
+    legacy = legacy_names(code)
+    name, scores = classifier.classify(code)
+    if set(legacy) != set(scores):
+      differ += 1
+      print('Different languages matched:', legacy, scores)
+    elif len(legacy) == 1 and name != language:
+      sys.exit('Picked {} for a {} block'.format(name, language))
+  print('Checked', len(blocks), 'code blocks,', differ, 'matched differently')
+
+
+def timed(name, blocks, classify, repeat):
+  start = time.perf_counter()
+  for i in range(repeat):
+    for language, code in blocks:
+      classify(code)
+  seconds = time.perf_counter() - start
+  print('{:>8}: {:8.2f} us/block'.format(name, seconds / repeat / len(blocks) * 1e6))
+  return seconds
+
+
+def main():
+  arg_parser = argparse.ArgumentParser()
+  arg_parser.add_argument('--repeat', type=int, default=20, metavar='N')
+  args = arg_parser.parse_args()
+
+  blocks = get_code_blocks()
+  if not blocks:
+    sys.exit('No code blocks in devguide to benchmark with')
+  size = sum(len(code) for language, code in blocks)
+  print(len(blocks), 'code blocks,', size, 'characters')
+  check(blocks)
+
+  classifier = code_language.CodeClassifier()
+  legacy = timed('old', blocks, legacy_names, args.repeat)
+  new = timed('scan', blocks, classifier.scores, args.repeat)
+  cached = timed('cached', blocks, classifier.classify, args.repeat)
+  print('Speedup: {:.1f}x scanning, {:.1f}x cached'.format(legacy / new, legacy / cached))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,85 @@
+# Measures get_text on paragraphs and table cells: time and text buffers
+# created per call. Converts the document normally in a temporary directory
+# first, then converts it again with the reference tables from that
+# conversion and get_text wrapped to time each call on a paragraph or table
+# cell node. Paragraphs inside table cells are counted in both, and code
+# lines are left out of the paragraphs.
+#
+#   OPENDDS_DEVGUIDE_ODT=... python bench/bench_get_text.py [--repeat N]
+
+import sys
+import os
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+repo_path = Path(__file__).resolve().parent.parent
+
+
+class TimedGetText:
+  def __init__(self, convert):
+    self.convert = convert
+    self.get_text = convert.get_text
+    self.stats = {}
+
+  def kind(self, info, node):
+    kind = node.qname[1]
+    if kind == 'p' and not info.getany('in_code', otherwise=False):
+      return 'paragraph'
+    if kind == 'table-cell':
+      return 'table cell'
+    return None
+
+  def __call__(self, info, node, *args):
+    kind = self.kind(info, node)
+    if kind is None:
+      return self.get_text(info, node, *args)
+    buffers = self.convert.TextBuffer.created
+    start = time.perf_counter()
+    rv = self.get_text(info, node, *args)
+    seconds = time.perf_counter() - start
+    stats = self.stats.setdefault(kind, [0, 0.0, 0])
+    stats[0] += 1
+    stats[1] += seconds
+    stats[2] += self.convert.TextBuffer.created - buffers
+    return rv
+
+
+def main():
+  arg_parser = argparse.ArgumentParser()
+  arg_parser.add_argument('--repeat', type=int, default=3, metavar='N')
+  arg_parser.add_argument('--reader', default='odfpy')
+  args = arg_parser.parse_args()
+
+  if 'OPENDDS_DEVGUIDE_ODT' not in os.environ:
+    sys.exit('OPENDDS_DEVGUIDE_ODT must be set')
+
+  sys.path.insert(0, str(repo_path))
+  import convert
+  with tempfile.TemporaryDirectory() as tmp:
+    os.chdir(tmp)
+    convert.Converter(os.environ['OPENDDS_DEVGUIDE_ODT'], reader=args.reader).convert()
+
+    best = {}
+    for i in range(args.repeat):
+      timed = TimedGetText(convert)
+      convert.get_text = timed
+      try:
+        info = convert.Info(convert.doc, convert.ref_info)
+        out = convert.Out()
+        convert.convert_node(info, convert.section, out)
+        out.close()
+      finally:
+        convert.get_text = timed.get_text
+      for kind, stats in timed.stats.items():
+        if kind not in best or stats[1] < best[kind][1]:
+          best[kind] = stats
+
+  for kind, (calls, seconds, buffers) in sorted(best.items()):
+    print('{:<11} {:6} calls {:8.1f} us per call {:6.2f} buffers per call'.format(
+      kind, calls, seconds / calls * 1e6, buffers / calls))
+
+
+if __name__ == '__main__':
+  main()
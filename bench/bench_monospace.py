@@ -0,0 +1,231 @@
+"""
+Checks MonospaceFixer against the character by character loops it replaced
+from convert.py on random input, then compares their throughput on the
+converted DevGuide.
+
+  python bench/bench_monospace.py [--fuzz N] [--repeat N]
+"""
+
+import sys
+import random
+import argparse
+import time
+from pathlib import Path
+
+repo_path = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(repo_path))
+
+from monospace import MonospaceFixer, fix_monospace
+
+
+# Old Implementation ==========================================================
+
+class LegacyOut:
+  def __init__(self):
+    self.newline_count = 0
+    self.keep_back = None
+    self.tilde_count = 0
+    self.inline_monospace_state = 0
+    self.last_char = None
+
+  def write(self, raw_string):
+    string = ''
+    for c in raw_string:
+      last_char = string[-1] if string else self.last_char
+      if c == '\n':
+        if self.keep_back:
+          string += self.keep_back
+          self.keep_back = None
+        string += '`' * self.tilde_count
+        self.tilde_count = 0
+        self.inline_monospace_state = 0
+        if self.newline_count == 2:
+          self.newline_count = 0
+          continue
+        self.newline_count += 1
+      elif c == '`':
+        self.newline_count = 0
+        if self.inline_monospace_state == 0: # Left of ``..``
+          if self.tilde_count == 1: # Almost Inside ``..``
+            if last_char.isalnum():
+              string += ' '
+            string += '``'
+            self.inline_monospace_state = 1
+            self.tilde_count = 0
+          else:
+            self.tilde_count += 1
+          continue
+        elif self.inline_monospace_state == 1: # Inside ``..``
+          if self.tilde_count == 1: # Almost Outside ``..``
+            self.keep_back = '``'
+            self.inline_monospace_state = 2
+            self.tilde_count = 0
+          else:
+            self.tilde_count += 1
+          continue
+        elif self.inline_monospace_state == 2: # After ``..``
+          if self.tilde_count == 1: # Almost Outside ``..``
+            self.tilde_count = 0
+            self.keep_back = None
+            self.inline_monospace_state = 1
+          else:
+            self.tilde_count += 1
+          continue
+      else:
+        if self.inline_monospace_state == 2: # After ``
+          string += self.keep_back
+          self.keep_back = None
+          if c.isalnum():
+            string += ' '
+          self.inline_monospace_state = 0
+        else:
+          if self.keep_back:
+            string += self.keep_back
+            self.keep_back = None
+          string += '`' * self.tilde_count
+          self.tilde_count = 0
+        self.newline_count = 0
+      string += c
+    if string:
+      self.last_char = string[-1]
+    return string
+
+
+def legacy_fix_monospace(raw_string, last_char_arg=None):
+  tick_count = 0
+  string = ''
+  keep_back = None
+  state = 0
+  for c in raw_string:
+    last_char = string[-1] if string else last_char_arg
+    if c == '`':
+      if state == 0: # Left of ``..``
+        if tick_count == 1: # Almost Inside ``..``
+          if last_char and last_char.isalnum():
+            string += ' '
+          string += '``'
+          state = 1
+          tick_count = 0
+        else:
+          tick_count += 1
+        continue
+      elif state == 1: # Inside ``..``
+        if tick_count == 1: # Almost Outside ``..``
+          keep_back = '``'
+          state = 2
+          tick_count = 0
+        else:
+          tick_count += 1
+        continue
+      elif state == 2: # After ``..``
+        if tick_count == 1: # Almost Outside ``..``
+          tick_count = 0
+          keep_back = None
+          state = 1
+        else:
+          tick_count += 1
+        continue
+    else:
+      if state == 2: # After ``
+        string += keep_back
+        keep_back = None
+        if c.isalnum():
+          string += ' '
+        state = 0
+      else:
+        if keep_back:
+          string += keep_back
+          keep_back = None
+        string += '`' * tick_count
+        tick_count = 0
+    string += c
+  if keep_back:
+    string += keep_back
+  if tick_count:
+    string += '`' * tick_count
+  return string
+
+
+# Fuzzing =====================================================================
+
+def random_text(rng):
+  pieces = ['`', '``', '```', '\n', '\n\n', ' ', 'a', 'word', '.', '-', ' x ']
+  return ''.join(rng.choice(pieces) for i in range(rng.randrange(1, 40)))
+
+
+def random_split(rng, text):
+  cuts = sorted(rng.sample(range(len(text) + 1), rng.randrange(0, min(len(text), 4) + 1)))
+  return [text[a:b] for a, b in zip([0] + cuts, cuts + [len(text)])]
+
+
+def fuzz(count, seed=0):
+  rng = random.Random(seed)
+  for i in range(count):
+    # The old write crashed on `` before anything else was written, so always
+    # start with something.
+    first = rng.choice('a. ')
+    writes = [first] + random_split(rng, random_text(rng))
+    legacy = LegacyOut()
+    fixer = MonospaceFixer()
+    expected = [legacy.write(w) for w in writes]
+    result = [fixer.feed(w) for w in writes]
+    if expected != result:
+      sys.exit('Out.write mismatch for {}:\n  {}\n  {}'.format(
+        repr(writes), repr(expected), repr(result)))
+
+    text = random_text(rng)
+    last_char = rng.choice([None, 'a', ' '])
+    expected = legacy_fix_monospace(text, last_char)
+    result = fix_monospace(text, last_char)
+    if expected != result:
+      sys.exit('fix_monospace mismatch for {}:\n  {}\n  {}'.format(
+        repr(text), repr(expected), repr(result)))
+  print('Fuzzed', count, 'cases, all the same')
+
+
+# Benchmark ===================================================================
+
+def throughput(name, writes, feed, repeat):
+  size = sum(len(w.encode('utf-8')) for w in writes) * repeat
+  start = time.perf_counter()
+  for i in range(repeat):
+    feed(writes)
+  seconds = time.perf_counter() - start
+  print('{:>8}: {:8.2f} MB/s'.format(name, size / seconds / 1e6))
+  return seconds
+
+
+def main():
+  arg_parser = argparse.ArgumentParser(description=__doc__,
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+  arg_parser.add_argument('--fuzz', type=int, default=20000, metavar='N')
+  arg_parser.add_argument('--repeat', type=int, default=3, metavar='N')
+  args = arg_parser.parse_args()
+
+  fuzz(args.fuzz)
+
+  # Use the converted DevGuide, split up into lines roughly like the writes
+  # the converter does.
+  writes = []
+  for path in sorted((repo_path / 'devguide').glob('*.rst')):
+    writes.extend(path.read_text().splitlines(keepends=True))
+  if not writes:
+    sys.exit('No .rst files in devguide to benchmark with')
+
+  def legacy_feed(writes):
+    out = LegacyOut()
+    for w in writes:
+      out.write(w)
+
+  def new_feed(writes):
+    fixer = MonospaceFixer()
+    for w in writes:
+      fixer.feed(w)
+
+  legacy = throughput('old', writes, legacy_feed, args.repeat)
+  new = throughput('new', writes, new_feed, args.repeat)
+  print('Speedup: {:.1f}x'.format(legacy / new))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,120 @@
+# Shows how convert.py scales with the size of the document. Generates
+# synthetic documents at multiples of the DevGuide's size with
+# synthetic_odt.py, converts each one in a temporary directory, and prints the
+# time and peak memory of each run. Then it prints how fast each phase and the
+# slowest kinds of nodes grow between sizes as the exponent k in time ~ size^k,
+# so anything well over 1 is growing faster than the document is.
+#
+#   python bench/bench_scaling.py [--scales 1,10,100] [-- CONVERT_ARGS...]
+#
+# The conversions are run with --report, which times every node and so is
+# slower than a normal run.
+
+import sys
+import os
+import math
+import json
+import argparse
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+repo_path = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import synthetic_odt
+
+
+def run(scale, args, tmp):
+  tmp = Path(tmp)
+  odt_path = tmp / 'synthetic.odt'
+  start = time.perf_counter()
+  doc = synthetic_odt.make_document(synthetic_odt.default_shape(scale), args.seed)
+  doc.save(str(odt_path))
+  print('Generated {}x document in {:.1f}s, {:.1f} MB'.format(
+    scale, time.perf_counter() - start, odt_path.stat().st_size / 1e6))
+
+  env = dict(os.environ, OPENDDS_DEVGUIDE_ODT=str(odt_path))
+  command = [sys.executable, str(repo_path / 'convert.py'),
+    '--report', str(tmp / 'report.json')] + args.convert_args
+  start = time.perf_counter()
+  with open(tmp / 'log.txt', 'w') as log:
+    process = subprocess.Popen(command, cwd=str(tmp), env=env,
+      stdout=log, stderr=subprocess.STDOUT)
+    # wait4 gives the peak memory of just this process, ru_maxrss is in KiB
+    pid, status, usage = os.wait4(process.pid, 0)
+  seconds = time.perf_counter() - start
+  if status != 0:
+    sys.exit('convert.py failed at {}x, see {}:\n{}'.format(
+      scale, tmp / 'log.txt', (tmp / 'log.txt').read_text()[-2000:]))
+
+  report = json.loads((tmp / 'report.json').read_text())
+  output_size = sum(p.stat().st_size for p in (tmp / 'devguide').glob('*.rst'))
+  return dict(scale=scale, seconds=seconds, peak=usage.ru_maxrss * 1024,
+    output_size=output_size, report=report)
+
+
+def exponent(small, large, scale_small, scale_large):
+  if small <= 0 or large <= 0:
+    return None
+  return math.log(large / small) / math.log(scale_large / scale_small)
+
+
+def print_growth(results, title, get_times):
+  print()
+  print(title)
+  names = list(dict.fromkeys(name for r in results for name in get_times(r)))
+  steps = list(zip(results, results[1:]))
+  print('  {:<32}'.format('') + ''.join('{:>12}'.format('{}x'.format(r['scale']))
+    for r in results) + ''.join('{:>12}'.format('k {}-{}x'.format(a['scale'], b['scale']))
+    for a, b in steps))
+  for name in names:
+    times = [get_times(r).get(name, 0) for r in results]
+    row = '  {:<32}'.format(name) + ''.join('{:>11.3f}s'.format(t) for t in times)
+    for (a, b), (ta, tb) in zip(steps, zip(times, times[1:])):
+      k = exponent(ta, tb, a['scale'], b['scale'])
+      row += '{:>12}'.format('-' if k is None else '{:.2f}{}'.format(k, ' !' if k > 1.15 else ''))
+    print(row)
+
+
+def main():
+  arg_parser = argparse.ArgumentParser()
+  arg_parser.add_argument('--scales', default='1,10,100', metavar='LIST',
+    help='comma separated multiples of the DevGuide size (default 1,10,100)')
+  arg_parser.add_argument('--seed', type=int, default=0, metavar='N')
+  arg_parser.add_argument('convert_args', nargs=argparse.REMAINDER,
+    help='more arguments for convert.py, after --')
+  args = arg_parser.parse_args()
+  if args.convert_args[:1] == ['--']:
+    args.convert_args = args.convert_args[1:]
+  scales = [float(s) if '.' in s else int(s) for s in args.scales.split(',')]
+
+  results = []
+  for scale in scales:
+    with tempfile.TemporaryDirectory() as tmp:
+      result = run(scale, args, tmp)
+    results.append(result)
+    print('  converted in {:.1f}s, {:.1f} MB peak, {:.1f} MB of RST'.format(
+      result['seconds'], result['peak'] / 1e6, result['output_size'] / 1e6))
+
+  print()
+  print('  {:>8} {:>10} {:>12} {:>12}'.format('scale', 'seconds', 'peak MB', 'MB/1x'))
+  for r in results:
+    print('  {:>7}x {:>10.2f} {:>12.1f} {:>12.1f}'.format(
+      r['scale'], r['seconds'], r['peak'] / 1e6, r['peak'] / 1e6 / r['scale']))
+  if len(results) < 2:
+    return
+
+  print_growth(results, 'Phases (wall time)',
+    lambda r: {p['name']: p['wall'] for p in r['report']['phases']})
+  # The node kinds that took the most time of their own at the largest size
+  largest = results[-1]['report']['node_kinds']
+  slowest = sorted(largest, key=lambda kind: largest[kind]['own_seconds'], reverse=True)[:10]
+  print_growth(results, 'Node kinds (own time)',
+    lambda r: {kind: r['report']['node_kinds'].get(kind, {}).get('own_seconds', 0)
+      for kind in slowest})
+
+
+if __name__ == '__main__':
+  main()
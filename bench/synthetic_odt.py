@@ -0,0 +1,442 @@
+# Writes synthetic ODT documents that are shaped like the DevGuide, for
+# benchmarking convert.py without the real one. They use the same style names
+# and the same kinds of nodes the converter looks for: a preface with
+# "PreHeader N" paragraphs, numbered headings, Note and P209 paragraphs,
+# numbered and bulleted lists, tables, monospace code paragraphs, Figure
+# paragraphs with images and captions, bookmarks and references to them and
+# to sections, and footnotes. The text comes from a seeded random generator,
+# so the same options always give the same document.
+#
+# The defaults are roughly the size of the DevGuide. --scale multiplies the
+# number of chapters.
+#
+#   python bench/synthetic_odt.py OUTPUT [--scale N] [--chapters N] ...
+
+import random
+import argparse
+import struct
+import zlib
+
+from odf.opendocument import OpenDocumentText
+from odf.style import Style, TextProperties, FontFace
+from odf.text import H, P, Span, A, S, Section, List, ListItem, ListStyle, \
+  ListLevelStyleNumber, ListLevelStyleBullet, BookmarkStart, BookmarkEnd, \
+  BookmarkRef, Sequence, SequenceRef, Note, NoteCitation, NoteBody
+from odf.table import Table, TableColumn, TableHeaderRows, TableRow, TableCell
+from odf.draw import Frame, TextBox, Image
+from odf.namespaces import DRAWNS
+
+
+# Per section amounts can be fractions for things that only show up every few
+# sections, like tables. Those are spread out evenly.
+shape_options = dict(
+  chapters=(16, 'chapters, not counting the preface'),
+  depth=(3, 'levels of headings in each chapter'),
+  subsections=(4, 'subsections in each section above the deepest level'),
+  paragraphs=(3, 'paragraphs of text per section'),
+  lists=(1.0, 'lists per section, alternating between numbered and bulleted'),
+  list_items=(4, 'items in each list, every other list has a nested list'),
+  tables=(0.15, 'tables per section'),
+  table_size=('8x3', 'rows and columns in each table'),
+  code_blocks=(0.8, 'code blocks per section'),
+  code_lines=(7, 'lines in each code block'),
+  notes=(0.3, 'Note paragraphs per section'),
+  refs=(1.0, 'references to other sections and bookmarks per section'),
+  footnotes=(0.01, 'footnotes per section'),
+  figures=(0.08, 'figures per section'),
+)
+
+
+def add_shape_arguments(arg_parser):
+  for name, (default, help) in shape_options.items():
+    arg_parser.add_argument('--' + name.replace('_', '-'), type=type(default),
+      default=default, metavar='N', help='{} (default {})'.format(help, default))
+  arg_parser.add_argument('--scale', type=float, default=1, metavar='N',
+    help='multiply the number of chapters by this')
+  arg_parser.add_argument('--seed', type=int, default=0, metavar='N')
+
+
+def scale_shape(shape, scale):
+  shape['chapters'] = max(1, round(shape['chapters'] * scale))
+  return shape
+
+
+def get_shape(args):
+  return scale_shape({name: getattr(args, name) for name in shape_options}, args.scale)
+
+
+def default_shape(scale=1):
+  return scale_shape({name: default for name, (default, help) in shape_options.items()}, scale)
+
+
+def spread(rate, i):
+  # How many of something happening rate times per section go in section i
+  return int((i + 1) * rate) - int(i * rate)
+
+
+# Text ========================================================================
+
+words = '''
+  the a of to and in is for that with data on by be are this as can when an
+  it which each from or if not will all used using any more these must also
+  sample value sequence participant publisher subscriber domain topic type
+  reader writer listener instance sample configuration transport discovery
+  policy quality service durable reliable history deadline liveliness
+  ownership partition presentation latency budget resource limits entity
+  message buffer network socket multicast unicast address port thread queue
+  application process library build option directory file example section
+  support default specification implementation interface generated
+'''.split()
+
+monospace_words = ('DataWriter', 'DataReader', 'DomainParticipant',
+  'TheParticipantFactory', 'DCPSConfigFile', 'opendds_idl', 'write()',
+  'take()', 'RELIABLE_RELIABILITY_QOS', '-DCPSDebugLevel', 'TypeSupport')
+
+paths = ('$DDS_ROOT/dds/DCPS/Service_Participant.h',
+  '$DDS_ROOT/dds/idl/opendds_idl.cpp', 'dds/DCPS/transport/tcp/TcpTransport.h',
+  '$DDS_ROOT/DevGuideExamples/DCPS/Messenger')
+
+code_snippets = (
+  ('module Messenger {', '  @topic', '  struct Message {',
+    '    @key long subject_id;', '    string from;', '    string text;',
+    '  };', '};'),
+  ('#include <dds/DCPS/Service_Participant.h>', '',
+    'int main(int argc, char* argv[])', '{',
+    '  DDS::DomainParticipantFactory_var dpf = TheParticipantFactoryWithArgs(argc, argv);',
+    '  participant->delete_contained_entities();', '  return 0;', '}'),
+  ('[common]', 'DCPSGlobalTransportConfig=myconfig', '', '[config/myconfig]',
+    'transports=mytcp', '', '[transport/mytcp]', 'transport_type=tcp'),
+  ('<?xml version="1.0" encoding="UTF-8"?>', '<dds>',
+    '  <qos_profile name="reliable">', '    <datawriter_qos/>',
+    '  </qos_profile>', '</dds>'),
+  ('public static void main(String[] args) {',
+    '  System.out.println("Starting publisher");', '  int count = 10;', '}'),
+  ('cd $DDS_ROOT/DevGuideExamples/DCPS/Messenger', 'mwc.pl -type gnuace',
+    'make', './run_test.pl'),
+  ('project(*idl): dcps {', '  idlflags += -Wb,stub_export_include=Messenger_Export.h',
+    '  IDL_Files {', '    Messenger.idl', '  }', '}'),
+)
+
+
+def make_png(width, height, rgb):
+  def chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + \
+      struct.pack('>I', zlib.crc32(kind + data))
+  row = b'\0' + bytes(rgb) * width
+  return b'\x89PNG\r\n\x1a\n' + \
+    chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) + \
+    chunk(b'IDAT', zlib.compress(row * height)) + chunk(b'IEND', b'')
+
+
+# Generator ===================================================================
+
+class Generator:
+  def __init__(self, shape, seed=0):
+    self.shape = shape
+    self.rng = random.Random(seed)
+    self.doc = OpenDocumentText()
+    self.add_styles()
+    self.section = Section(name='Section1')
+    self.doc.text.addElement(self.section)
+    self.section_count = 0
+    self.list_count = 0
+    self.table_count = 0
+    self.code_count = 0
+    self.figure_count = 0
+    self.footnote_count = 0
+    self.note_count = 0
+    self.figures = []
+    self.plan_sections()
+
+  def add_styles(self):
+    doc = self.doc
+    doc.fontfacedecls.addElement(FontFace(name='Courier New',
+      fontfamily="'Courier New'", fontfamilygeneric='modern', fontpitch='fixed'))
+
+    def add(name, parent=None, display_name=None, automatic=False, **text_props):
+      style = Style(name=name, family='paragraph')
+      if display_name is not None:
+        style.setAttribute('displayname', display_name)
+      if parent is not None:
+        style.setAttribute('parentstylename', parent)
+      if text_props:
+        style.addElement(TextProperties(**text_props))
+      (doc.automaticstyles if automatic else doc.styles).addElement(style)
+
+    add('Standard')
+    add('Text_20_body', 'Standard', 'Text body')
+    add('Text_20_body_20_indent', 'Text_20_body', 'Text body indent')
+    add('Note', 'Text_20_body')
+    add('P209', 'Text_20_body_20_indent', automatic=True, fontweight='bold')
+    add('Heading', 'Standard')
+    for level in range(1, 11):
+      add('Heading_20_{}'.format(level), 'Heading', 'Heading {}'.format(level))
+    add('PreHeader_20_1', 'Heading_20_1', 'PreHeader 1')
+    add('PreHeader_20_2', 'Heading_20_2', 'PreHeader 2')
+    add('Code', 'Standard', fontname='Courier New', fontfamily="'Courier New'")
+    add('Caption', 'Standard')
+    add('Figure', 'Caption')
+    add('List', 'Text_20_body')
+    add('Table_20_Contents', 'Standard', 'Table Contents')
+    add('Footnote', 'Standard')
+
+    for name, kind in (('T_mono', dict(fontname='Courier New')),
+        ('T_bold', dict(fontweight='bold')), ('T_italic', dict(fontstyle='italic'))):
+      style = Style(name=name, family='text')
+      style.addElement(TextProperties(**kind))
+      doc.automaticstyles.addElement(style)
+
+    numbered = ListStyle(name='Numbering_20_1', displayname='Numbering 1')
+    bulleted = ListStyle(name='List_20_1', displayname='List 1')
+    for level in range(1, 4):
+      numbered.addElement(ListLevelStyleNumber(level=level, numformat='1',
+        numsuffix='.'))
+      bulleted.addElement(ListLevelStyleBullet(level=level, bulletchar='•'))
+    doc.styles.addElement(numbered)
+    doc.styles.addElement(bulleted)
+
+  def plan_sections(self):
+    # Titles and section numbers of every section, known up front so that
+    # references can point forward as well as back. The preface is 0.
+    shape = self.shape
+    self.sections = []
+
+    def plan(number, level):
+      self.sections.append((number, level, self.title() + ' ' + number))
+      if level < shape['depth']:
+        for i in range(1, shape['subsections'] + 1):
+          plan('{}.{}'.format(number, i), level + 1)
+
+    for chapter in range(1, shape['chapters'] + 1):
+      plan(str(chapter), 1)
+
+  # Text --------------------------------------------------------------------
+
+  def title(self):
+    return ' '.join(self.rng.choice(words) for i in range(self.rng.randint(1, 4))).title()
+
+  def sentence(self, parent):
+    rng = self.rng
+    count = rng.randint(6, 20)
+    texts = [rng.choice(words) for i in range(count)]
+    texts[0] = texts[0].capitalize()
+    # About half of the sentences have some inline markup in the middle
+    if rng.random() < 0.5:
+      i = rng.randrange(1, count)
+      parent.addText(' '.join(texts[:i]) + ' ')
+      kind = rng.random()
+      if kind < 0.5:
+        parent.addElement(Span(stylename='T_mono', text=rng.choice(monospace_words)))
+      elif kind < 0.6:
+        parent.addElement(Span(stylename='T_mono', text=rng.choice(paths)))
+      elif kind < 0.75:
+        parent.addElement(Span(stylename='T_bold', text=rng.choice(words)))
+      elif kind < 0.9:
+        parent.addElement(Span(stylename='T_italic', text=rng.choice(words)))
+      else:
+        parent.addElement(A(href='https://opendds.org', text=rng.choice(words)))
+      texts = [''] + texts[i:]
+    parent.addText(' '.join(texts) + rng.choice('........?:') + ' ')
+
+  def paragraph(self, style='Text_20_body', sentences=None):
+    p = P(stylename=style)
+    for i in range(sentences or self.rng.randint(1, 4)):
+      self.sentence(p)
+    return p
+
+  # Parts of Sections -------------------------------------------------------
+
+  def add_list(self, parent, level=1):
+    self.list_count += 1
+    numbered = self.list_count % 2 == 0
+    l = List(stylename='Numbering_20_1' if numbered else 'List_20_1')
+    for i in range(self.shape['list_items'] if level == 1 else 2):
+      item = ListItem()
+      item.addElement(self.paragraph('List', self.rng.randint(1, 2)))
+      if level == 1 and i == 1 and self.list_count % 3 == 0:
+        self.add_list(item, level + 1)
+      l.addElement(item)
+    parent.addElement(l)
+
+  def add_table(self, parent):
+    self.table_count += 1
+    rows, columns = (int(n) for n in self.shape['table_size'].split('x'))
+    table = Table(name='Table{}'.format(self.table_count))
+    table.addElement(TableColumn(numbercolumnsrepeated=columns))
+    header = TableHeaderRows()
+    table.addElement(header)
+    for r in range(rows):
+      row = TableRow()
+      for c in range(columns):
+        cell = TableCell(valuetype='string')
+        p = P(stylename='Table_20_Contents')
+        if r and c == 0:
+          p.addElement(Span(stylename='T_mono', text=self.rng.choice(monospace_words)))
+        else:
+          p.addText(' '.join(self.rng.choice(words)
+            for i in range(self.rng.randint(1, 3 if r == 0 else 12))))
+        cell.addElement(p)
+        row.addElement(cell)
+      (header if r == 0 else table).addElement(row)
+    parent.addElement(table)
+
+  def add_note(self, parent):
+    self.note_count += 1
+    parent.addElement(self.paragraph('Note' if self.note_count % 2 else 'P209', 2))
+
+  def add_code(self, parent):
+    parent.addElement(self.paragraph(sentences=1))
+    snippet = code_snippets[self.code_count % len(code_snippets)]
+    self.code_count += 1
+    for i in range(self.shape['code_lines']):
+      line = snippet[i % len(snippet)]
+      p = P(stylename='Code')
+      stripped = line.lstrip(' ')
+      if len(stripped) < len(line):
+        p.addElement(S(c=len(line) - len(stripped)))
+      p.addText(stripped)
+      parent.addElement(p)
+
+  def add_figure(self, parent):
+    self.figure_count += 1
+    n = self.figure_count
+    # Every image is different so they don't get deduplicated
+    name = 'Pictures/{:08d}.png'.format(n)
+    self.doc.addPicture(name, 'image/png',
+      make_png(40 + n % 97, 30 + n // 97 % 97, (n * 37 % 256, n * 91 % 256, 128)))
+    outer = P(stylename='Text_20_body')
+    frame = Frame(name='Frame{}'.format(n), anchortype='paragraph', width='4in')
+    box = TextBox()
+    caption = P(stylename='Figure')
+    image_frame = Frame(name='Image{}'.format(n), anchortype='paragraph',
+      width='4in', height='3in')
+    image = Image(href=name, type='simple', show='embed', actuate='onLoad')
+    image.setAttrNS(DRAWNS, 'mime-type', 'image/png')
+    image_frame.addElement(image)
+    caption.addElement(image_frame)
+    caption.addText('Figure ')
+    ref_name = 'refFigure{}'.format(n)
+    caption.addElement(Sequence(refname=ref_name, name='Figure',
+      formula='ooow:Figure+1', numformat='1', text=str(n)))
+    caption.addElement(S())
+    caption.addText(self.title())
+    box.addElement(caption)
+    frame.addElement(box)
+    outer.addElement(frame)
+    parent.addElement(outer)
+    self.figures.append((ref_name, n))
+
+  def add_refs(self, p, count):
+    rng = self.rng
+    for i in range(count):
+      p.addText('See ')
+      kind = rng.random()
+      if kind < 0.5:
+        number, level, title = rng.choice(self.sections)
+        p.addElement(BookmarkRef(referenceformat='chapter',
+          refname=self.heading_bookmark(number), text=number))
+      elif kind < 0.8 or not self.figures:
+        number, level, title = rng.choice(self.sections)
+        p.addElement(BookmarkRef(referenceformat='text',
+          refname=self.text_bookmark(number), text=title + ' details'))
+      else:
+        ref_name, n = rng.choice(self.figures)
+        p.addElement(SequenceRef(referenceformat='category-and-value',
+          refname=ref_name, text='Figure {}'.format(n)))
+      p.addText(' for more. ')
+
+  def add_footnote(self, p):
+    self.footnote_count += 1
+    n = self.footnote_count
+    note = Note(id='ftn{}'.format(n), noteclass='footnote')
+    note.addElement(NoteCitation(text=str(n)))
+    body = NoteBody()
+    body.addElement(self.paragraph('Footnote', 1))
+    note.addElement(body)
+    p.addElement(note)
+
+  # Sections ----------------------------------------------------------------
+
+  @staticmethod
+  def heading_bookmark(number):
+    return '__RefHeading__{}'.format(number.replace('.', '_'))
+
+  @staticmethod
+  def text_bookmark(number):
+    return 'ref_{}'.format(number.replace('.', '_'))
+
+  def add_preface(self):
+    self.section.addElement(P(stylename='PreHeader_20_1', text='Preface'))
+    for i in range(3):
+      self.section.addElement(P(stylename='PreHeader_20_2', text=self.title()))
+      for j in range(self.shape['paragraphs']):
+        self.section.addElement(self.paragraph())
+
+  def add_section(self, number, level, title):
+    shape = self.shape
+    i = self.section_count
+    self.section_count += 1
+    parent = self.section
+
+    h = H(outlinelevel=level, stylename='Heading_20_{}'.format(level))
+    name = self.heading_bookmark(number)
+    h.addElement(BookmarkStart(name=name))
+    h.addText(title)
+    h.addElement(BookmarkEnd(name=name))
+    parent.addElement(h)
+
+    # The first paragraph has the bookmark for references to this section
+    p = P(stylename='Text_20_body')
+    name = self.text_bookmark(number)
+    p.addElement(BookmarkStart(name=name))
+    p.addText(title + ' details')
+    p.addElement(BookmarkEnd(name=name))
+    p.addText(' are described here. ')
+    self.add_refs(p, spread(shape['refs'], i))
+    for k in range(spread(shape['footnotes'], i)):
+      self.add_footnote(p)
+    parent.addElement(p)
+
+    # Everything else goes between the paragraphs, in turn after each one
+    extras = []
+    for k in range(spread(shape['lists'], i)):
+      extras.append(self.add_list)
+    for k in range(spread(shape['code_blocks'], i)):
+      extras.append(self.add_code)
+    for k in range(spread(shape['notes'], i)):
+      extras.append(self.add_note)
+    for k in range(spread(shape['tables'], i)):
+      extras.append(self.add_table)
+    for k in range(spread(shape['figures'], i)):
+      extras.append(self.add_figure)
+    positions = max(shape['paragraphs'], 1)
+    for j in range(positions):
+      if j < shape['paragraphs']:
+        parent.addElement(self.paragraph())
+      for extra in extras[j::positions]:
+        extra(parent)
+
+  def generate(self):
+    self.add_preface()
+    for section in self.sections:
+      self.add_section(*section)
+    return self.doc
+
+
+def make_document(shape, seed=0):
+  return Generator(shape, seed).generate()
+
+
+def main():
+  arg_parser = argparse.ArgumentParser(
+    description='Write a synthetic DevGuide-like ODT document.')
+  arg_parser.add_argument('output', metavar='OUTPUT')
+  add_shape_arguments(arg_parser)
+  args = arg_parser.parse_args()
+
+  doc = make_document(get_shape(args), args.seed)
+  doc.save(args.output)
+
+
+if __name__ == '__main__':
+  main()
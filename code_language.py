@@ -0,0 +1,92 @@
+# Guessing the language of code blocks for the code-block directive
+#
+# Each language has regexes for things that should only show up in that
+# language. They are all combined into one regex, so a block is scanned once
+# and every match counts towards the score of its language. If more than one
+# language matches, the one that comes first in the priority order is used,
+# whatever the scores are. The scores are kept for diagnostics.
+
+import re
+
+
+# Every alternative has to start with a plain or escaped character. The
+# combined regex keeps that character outside of the group that says which
+# language matched, which lets re skip straight to the places where any of
+# the alternatives could start instead of trying all of them everywhere.
+languages = {
+  'omg-idl': ('@key', '@topic', 'module DDS', 'interface', 'enum', 'boolean', 'struct'),
+  'ini': (r'\[common]', r'\[transport', r'\[domain', r'\[config'),
+  'xml': ('xml version="1.0"',),
+  'cpp': ('int main', r'#include.*\.h[">]', 'int ACE_TMAIN', '_var ',
+    'OpenDDS::DCPS::', 'std::', r'-(?<=\w-)>'), # Last one is \w->
+  'java': ('public static void main', 'System.out.println', 'Helper',
+    r'null\b(?<!\wnull)'), # Last one is \bnull\b, so not C++'s nullptr
+  'bash': (r'\$(ACE|DDS)',),
+  'doscon': (r'\%(ACE|DDS)',),
+  'mpc': (r'project[\(:]',),
+}
+
+# The more specific languages come first, IDL is last of the C-like ones
+# since its keywords also show up in C++ and Java.
+default_priority = ('xml', 'ini', 'mpc', 'cpp', 'java', 'omg-idl', 'bash', 'doscon')
+
+
+class CodeClassifier:
+  # Most recently used blocks kept in the cache
+  cache_size = 4096
+
+  def __init__(self, priority=default_priority, patterns=languages):
+    self.patterns = patterns
+    self.set_priority(priority)
+    self.group_names = {}
+    parts = []
+    for name, alternatives in patterns.items():
+      for pattern in alternatives:
+        group = 'g{}'.format(len(self.group_names))
+        self.group_names[group] = name
+        split = 2 if pattern[0] == '\\' else 1
+        parts.append('{}(?P<{}>{})'.format(pattern[:split], group, pattern[split:]))
+    self.regex = re.compile('|'.join(parts))
+    self.cache = {}
+    self.hits = 0
+    self.misses = 0
+
+  def set_priority(self, priority):
+    # Languages left out of priority go after the others. The cache is kept,
+    # but the languages picked for it are picked again.
+    order = list(priority) + [name for name in self.patterns if name not in priority]
+    self.rank = {name: i for i, name in enumerate(order)}
+    if hasattr(self, 'cache'):
+      self.cache = {code: (self.pick(scores), scores)
+        for code, (name, scores) in self.cache.items()}
+
+  def pick(self, scores):
+    if not scores:
+      return None
+    return min(scores, key=self.rank.__getitem__)
+
+  def scores(self, code):
+    # Number of matches for each language that matched at all. The named
+    # group always closes after any groups inside it, so it's lastgroup.
+    scores = {}
+    for match in self.regex.finditer(code):
+      name = self.group_names[match.lastgroup]
+      scores[name] = scores.get(name, 0) + 1
+    return scores
+
+  def classify(self, code):
+    # Returns the language to use, or None if nothing matched, and the scores
+    # of every language that matched. Results are cached by the code itself,
+    # since hashing a str is faster than any digest of it. Dicts keep their
+    # order, so moving hits to the end leaves the least recently used first.
+    result = self.cache.pop(code, None)
+    if result is not None:
+      self.hits += 1
+    else:
+      self.misses += 1
+      scores = self.scores(code)
+      result = (self.pick(scores), scores)
+      if len(self.cache) >= self.cache_size:
+        del self.cache[next(iter(self.cache))]
+    self.cache[code] = result
+    return result
@@ -19,6 +19,7 @@
 import os
 import sys
 sys.path.insert(0, os.path.abspath('.') + '/ext')
+sys.path.insert(0, os.path.abspath('.')) # For convert.py
 
 github_link_repo = 'objectcomputing/OpenDDS'
 github_link_commitish = 'master'
@@ -34,6 +35,8 @@ github_link_commitish = 'master'
 # ones.
 extensions = [
   'github_link',
+  'devguide_odt',
+  'highlight_cache',
 ]
 from mpc_lexer import MpcLexer
 
@@ -74,7 +77,8 @@ language = 'en'
 # directories to ignore when looking for source files.
 # This patterns also effect to html_static_path and html_extra_path
 exclude_patterns = [
-    'README.rst'
+    'README.rst',
+    '.convert_cache', # Chapters kept by convert.py --incremental
 ]
 
 # The name of the Pygments (syntax highlighting) style to use.
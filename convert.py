@@ -1,17 +1,194 @@
+import time
+start_time = time.perf_counter()
+start_cpu_time = time.process_time()
+
 import sys
 import os
 from pathlib import Path
-import io
 import re
+import argparse
+import multiprocessing
+import hashlib
+import json
+import shutil
+import io
+import sqlite3
+import pickle
+import importlib.metadata
+import gzip
+import zipfile
+import zlib
+import concurrent.futures
 
-import odf
 from odf import text, element
+from odf.element import _handle_unrepresentable
 from odf.opendocument import load
+from odf.text import Section
 
 from slugify import slugify
 
-doc = load(os.environ['OPENDDS_DEVGUIDE_ODT'])
-opendds_root = Path(os.environ.get('DDS_ROOT', None))
+import odt_reader
+from monospace import MonospaceFixer, fix_monospace
+import code_language
+
+
+class Timings:
+  # How long each phase of the run took, in wall and CPU time of this
+  # process. Things that are only done when they are first needed, like
+  # loading the sentence tokenizer, are recorded separately and are also part
+  # of the phase they happened in.
+  def __init__(self, start, start_cpu):
+    self.last = start
+    self.last_cpu = start_cpu
+    self.phases = []
+    self.lazy = []
+
+  def mark(self, name):
+    now = time.perf_counter()
+    now_cpu = time.process_time()
+    self.phases.append((name, now - self.last, now_cpu - self.last_cpu))
+    self.last = now
+    self.last_cpu = now_cpu
+
+  def record(self, name, seconds):
+    self.lazy.append((name, seconds))
+
+  def print(self, file=sys.stdout):
+    print('Timings:                           wall       cpu', file=file)
+    for name, seconds, cpu in self.phases:
+      print('  {:<30} {:8.3f}s {:8.3f}s'.format(name, seconds, cpu), file=file)
+    print('  {:<30} {:8.3f}s {:8.3f}s'.format('total',
+      sum(p[1] for p in self.phases), sum(p[2] for p in self.phases)), file=file)
+    for name, seconds in self.lazy:
+      print('  {:<30} {:8.3f}s (part of the above)'.format(name, seconds), file=file)
+
+  def to_json(self):
+    return dict(
+      phases=[dict(name=name, wall=seconds, cpu=cpu) for name, seconds, cpu in self.phases],
+      lazy=[dict(name=name, wall=seconds) for name, seconds in self.lazy],
+    )
+
+
+# Replaced by the one for each conversion, this one also has the imports
+timings = Timings(start_time, start_cpu_time)
+
+
+def get_arg_parser():
+  arg_parser = argparse.ArgumentParser(
+    description='Convert the OpenDDS DevGuide ODT to RST')
+  arg_parser.add_argument('--reader', choices=('odfpy', 'stream'), default='odfpy',
+    help='How to read the ODT: odfpy loads the full odfpy DOM, stream builds a '
+      'lighter tree directly from the XML in the archive. Output is the same.')
+  arg_parser.add_argument('--single-pass', action='store_true',
+    help='Number sections and collect references while converting instead of in '
+      'a separate pass first, then fill in the ref targets at the end. Output is '
+      'the same.')
+  arg_parser.add_argument('--jobs', '-j', type=int, default=1, metavar='N',
+    help='Convert chapters in N worker processes after the reference pass')
+  arg_parser.add_argument('--incremental', action='store_true',
+    help='Reuse chapters converted by earlier runs if the parts of the document '
+      'they were converted from and the targets of their references are the same')
+  arg_parser.add_argument('--cache-dir', default='.convert_cache', metavar='PATH',
+    help='Where converted chapters for --incremental, the sentence cache and '
+      'the lists of files written to the output are kept. Default is %(default)s')
+  arg_parser.add_argument('--no-sentence-cache', action='store_true',
+    help='Don\'t keep sentence splitting results in --cache-dir for later runs')
+  arg_parser.add_argument('--sentence-cache-size', type=int, default=32, metavar='MB',
+    help='Least recently used sentence splitting results are dropped to keep the '
+      'cache under this size. Default is %(default)s')
+  arg_parser.add_argument('--sentence-jobs', type=int, default=0, metavar='N',
+    help='Split paragraphs into sentences in N worker processes while '
+      'converting instead of as each paragraph is converted')
+  arg_parser.add_argument('--punkt', metavar='PATH',
+    help='Punkt sentence tokenizer model (english.pickle) to use instead of the '
+      'one installed in nltk_data')
+  arg_parser.add_argument('--code-priority', metavar='LANGS',
+    default=','.join(code_language.default_priority),
+    help='Comma separated order to pick the language of a code block in when '
+      'more than one matches, however often each one does. Default is %(default)s')
+  arg_parser.add_argument('--dump', default='', metavar='KINDS',
+    help='Comma separated diagnostic dumps to write to the dump directory: xml '
+      '(the document), nodes (the document as a node listing), sections (section '
+      'numbers and labels), styles (every value used for each style property) or '
+      'all. None are written by default.')
+  arg_parser.add_argument('--dump-gzip', action='store_true',
+    help='Compress the dumps with gzip')
+  arg_parser.add_argument('--timings', action='store_true',
+    help='Print how long each phase of the run took')
+  arg_parser.add_argument('--report', metavar='PATH',
+    help='Write a JSON report with the time each phase took, counts and times '
+      'for each kind of node converted, and other counters. Timing the nodes '
+      'slows down the conversion a bit.')
+  arg_parser.add_argument('--profile', metavar='PATH',
+    help='Write cProfile stats of the conversion phase to PATH for pstats. Only '
+      'covers the main process.')
+  arg_parser.add_argument('--sync-to', metavar='PATH',
+    help='Also copy the output to PATH, like $DDS_ROOT/docs/devguide, only '
+      'replacing the files that changed since the last time')
+  arg_parser.add_argument('--sync-only', action='store_true',
+    help='Don\'t convert, just copy the output of the last conversion to '
+      '--sync-to, like after checking it builds')
+  arg_parser.add_argument('--watch', action='store_true',
+    help='Keep running after converting and convert again each time the ODT '
+      'changes, keeping everything that was loaded. Implies --incremental, so '
+      'only the chapters that changed are converted again.')
+  arg_parser.add_argument('--watch-interval', type=float, default=1.0, metavar='SECONDS',
+    help='How often --watch checks the ODT for changes. Default is %(default)s')
+  arg_parser.add_argument('--batch', nargs=2, action='append', metavar=('ODT', 'OUTPUT'),
+    help='Convert ODT to the OUTPUT directory instead of converting '
+      'OPENDDS_DEVGUIDE_ODT to devguide. Can be given more than once to convert '
+      'several documents in one process, which keeps the sentence tokenizer and '
+      'caches loaded between them. A document that fails doesn\'t stop the rest.')
+  arg_parser.add_argument('--batch-jobs', type=int, default=1, metavar='N',
+    help='Convert the --batch documents in N worker processes')
+  return arg_parser
+
+
+dump_kinds = ('xml', 'nodes', 'sections', 'styles')
+
+
+def check_options(options):
+  # Fills in and checks options from the command line or Converter, raising
+  # ValueError for anything wrong with them. code_priority and dump can be
+  # comma separated strings like on the command line or lists.
+  if isinstance(options.code_priority, str):
+    options.code_priority = options.code_priority.split(',')
+  if isinstance(options.dump, str):
+    options.dump = options.dump.split(',')
+  options.dump = set(options.dump) - {''}
+  if 'all' in options.dump:
+    options.dump = set(dump_kinds)
+  for name in options.dump:
+    if name not in dump_kinds:
+      raise ValueError('Unknown kind of dump in --dump: ' + name)
+  for name in options.code_priority:
+    if name not in code_language.languages:
+      raise ValueError('Unknown code language in --code-priority: ' + name)
+  if options.single_pass:
+    if options.watch:
+      raise ValueError('--watch needs the reference pass, so it can\'t be used with --single-pass')
+    if options.jobs > 1:
+      raise ValueError('--jobs needs the reference pass, so it can\'t be used with --single-pass')
+    if options.incremental:
+      raise ValueError('--incremental needs the reference pass, so it can\'t be used with --single-pass')
+  if options.watch:
+    options.incremental = True
+  if options.jobs > 1 or options.sentence_jobs:
+    if 'fork' not in multiprocessing.get_all_start_methods():
+      print('Warning: --jobs and --sentence-jobs need fork, converting serially', file=sys.stderr)
+      options.jobs = 1
+      options.sentence_jobs = 0
+
+
+# The options of the conversion in progress, set by Converter.convert
+args = None
+
+
+class ConversionError(RuntimeError):
+  # A document can't be converted. Raised instead of exiting so a batch can
+  # go on to the next document.
+  pass
+
 
 # Tasks to do manually
 # - Merge Installation Section with INSTALL.md
@@ -46,57 +223,267 @@ opendds_root = Path(os.environ.get('DDS_ROOT', None))
 
 # One Sentence per Line =======================================================
 
-import nltk
+# NLTK is slow to import and the punkt model is slow to load, so both are
+# put off until a paragraph actually needs splitting. The model has to be
+# installed already, it isn't downloaded. Once loaded, models are kept for
+# later conversions in the same process.
 
-nltk.download('punkt')
+punkt_resource = 'tokenizers/punkt/english.pickle'
+punkt_paths = {} # By --punkt, None for the one in nltk_data
+sentence_tokenizers = {} # By path
+punkt_versions = {} # By path
 
-import nltk.data
+# Punkt only breaks sentences after one of these (sent_end_chars of the
+# English model)
+sentence_end_re = re.compile(r'[.?!]')
 
-sentence_tokenizer = nltk.data.load('tokenizers/punkt/english.pickle')
 
-def one_sentence_per_line(text, indent_following_lines=''):
+def get_nltk_version():
+  return importlib.metadata.version('nltk')
+
+
+def find_punkt():
+  punkt_path = punkt_paths.get(args.punkt, None)
+  if punkt_path is None:
+    if args.punkt:
+      punkt_path = Path(args.punkt)
+    else:
+      start = time.perf_counter()
+      import nltk.data
+      try:
+        punkt_path = Path(str(nltk.data.find(punkt_resource)))
+      except LookupError:
+        raise ConversionError('Could not find the punkt model for splitting sentences. '
+          'Install it with "python -m nltk.downloader punkt" or pass it using --punkt')
+      timings.record('importing nltk', time.perf_counter() - start)
+    punkt_paths[args.punkt] = punkt_path
+  return punkt_path
+
+
+def get_sentence_tokenizer():
+  path = find_punkt()
+  sentence_tokenizer = sentence_tokenizers.get(path, None)
+  if sentence_tokenizer is None:
+    start = time.perf_counter()
+    with path.open('rb') as f:
+      sentence_tokenizer = pickle.load(f)
+    sentence_tokenizers[path] = sentence_tokenizer
+    timings.record('loading punkt model', time.perf_counter() - start)
+  return sentence_tokenizer
+
+
+def get_punkt_version():
+  path = find_punkt()
+  version = punkt_versions.get(path, None)
+  if version is None:
+    hasher = hashlib.sha256(get_nltk_version().encode('utf-8'))
+    hasher.update(path.read_bytes())
+    version = punkt_versions[path] = hasher.hexdigest()
+  return version
+
+
+class SentenceCache:
+  # Results of one_sentence_per_line from earlier runs, kept in an SQLite
+  # database and keyed by the text, the indent and the punkt model. The
+  # database is only opened when a paragraph actually needs it. New results
+  # are written at the end of the run, when the least recently used results
+  # are evicted to keep it under max_size bytes. With no path nothing is
+  # cached, but the counts are still kept.
+  def __init__(self, path=None, max_size=0):
+    self.path = path
+    self.max_size = max_size
+    self.model = None
+    self.db = None
+    self.pid = None
+    self.new = {}
+    self.used = set()
+    self.hits = 0
+    self.misses = 0
+    self.skipped = 0
+    self.saved = 0.0
+    self.spent = 0.0
+
+  def key(self, text, indent):
+    if self.model is None:
+      self.model = get_punkt_version()
+    return hashlib.sha256(
+      '\0'.join((self.model, indent, text)).encode('utf-8')).digest()
+
+  def connect(self, create=False):
+    # Worker processes are forked, so they can't use a connection the parent
+    # opened.
+    if self.db is None or self.pid != os.getpid():
+      if not create and not self.path.is_file():
+        return None
+      self.path.parent.mkdir(parents=True, exist_ok=True)
+      # Batch workers can be saving at the same time
+      self.db = sqlite3.connect(str(self.path), timeout=60)
+      self.db.execute('CREATE TABLE IF NOT EXISTS sentences '
+        '(key BLOB PRIMARY KEY, text TEXT, seconds REAL, used INTEGER)')
+      self.pid = os.getpid()
+    return self.db
+
+  def lookup(self, key):
+    entry = self.new.get(key, None)
+    if entry is None:
+      db = self.connect()
+      if db is not None:
+        entry = db.execute(
+          'SELECT text, seconds FROM sentences WHERE key = ?', (key,)).fetchone()
+    return entry
+
+  def contains(self, text, indent):
+    return self.path is not None and self.lookup(self.key(text, indent)) is not None
+
+  def get(self, text, indent):
+    if self.path is None:
+      return None
+    key = self.key(text, indent)
+    entry = self.lookup(key)
+    if entry is None:
+      return None
+    self.hits += 1
+    self.saved += entry[1]
+    self.used.add(key)
+    return entry[0]
+
+  def add(self, text, indent, result, seconds):
+    self.misses += 1
+    self.spent += seconds
+    if self.path is not None:
+      self.new[self.key(text, indent)] = (result, seconds)
+
+  def take(self):
+    # Hands what was done in a worker process over to the parent
+    state = dict(new=self.new, used=self.used, hits=self.hits,
+      misses=self.misses, skipped=self.skipped, saved=self.saved, spent=self.spent)
+    self.new = {}
+    self.used = set()
+    self.hits = self.misses = self.skipped = 0
+    self.saved = self.spent = 0.0
+    return state
+
+  def merge(self, state):
+    self.new.update(state['new'])
+    self.used.update(state['used'])
+    self.hits += state['hits']
+    self.misses += state['misses']
+    self.skipped += state['skipped']
+    self.saved += state['saved']
+    self.spent += state['spent']
+
+  def save(self):
+    if self.path is None or not (self.new or self.used):
+      return
+    db = self.connect(create=True)
+    now = int(time.time())
+    with db:
+      db.executemany('INSERT OR REPLACE INTO sentences VALUES (?, ?, ?, ?)',
+        [(key, text, seconds, now) for key, (text, seconds) in self.new.items()])
+      db.executemany('UPDATE sentences SET used = ? WHERE key = ?',
+        [(now, key) for key in self.used])
+      evicted = db.execute(
+        'DELETE FROM sentences WHERE key IN ('
+          'SELECT key FROM ('
+            'SELECT key, SUM(LENGTH(key) + LENGTH(CAST(text AS BLOB)) + 16) '
+              'OVER (ORDER BY used DESC, key) AS total FROM sentences) '
+          'WHERE total > ?)', (self.max_size,)).rowcount
+    if evicted:
+      db.execute('VACUUM')
+    db.close()
+    self.db = None
+
+  def __repr__(self):
+    return '{} hits, {} misses, {} without sentence ends, ' \
+      '{:.2f}s saved, {:.2f}s splitting'.format(self.hits, self.misses,
+        self.skipped, self.saved, self.spent)
+
+
+def get_sentence_cache():
+  if args.no_sentence_cache:
+    return SentenceCache()
+  return SentenceCache(Path(args.cache_dir) / 'sentences.sqlite',
+    args.sentence_cache_size * 1024 * 1024)
+
+
+# Replaced for each conversion
+sentence_cache = SentenceCache()
+
+
+def segment_sentences(text, indent_following_lines):
   lines = []
-  for line in sentence_tokenizer.tokenize(text):
+  for line in get_sentence_tokenizer().tokenize(text):
     if indent_following_lines and lines:
       line = indent_following_lines + line
     lines.append(line)
   return '\n'.join(lines)
 
 
+def needs_splitting(text):
+  # Punkt would return text without any sentence ends as one sentence as is
+  return not text or text[-1].isspace() or sentence_end_re.search(text)
+
+
+def mask_deferred_refs(text):
+  # Replaces the placeholders Info.ref_target leaves in single pass mode with
+  # a label that isn't in the text otherwise, so punkt and the sentence cache
+  # see the same text however the references are numbered. Returns the text
+  # and what unmask_deferred_refs needs to put them back, or None.
+  if '\x00' not in text:
+    return text, None
+  refs = [m.group(0) for m in deferred_ref_re.finditer(text)]
+  if not refs:
+    return text, None
+  label = 'deferred-target'
+  n = 1
+  while label in text:
+    n += 1
+    label = 'deferred-target-{}'.format(n)
+  return deferred_ref_re.sub(label, text), (label, refs)
+
+
+def unmask_deferred_refs(text, mask):
+  # Punkt doesn't split inside a word, so the labels are still there in order
+  if mask is None:
+    return text
+  label, refs = mask
+  parts = text.split(label)
+  return parts[0] + ''.join(ref + part for ref, part in zip(refs, parts[1:]))
+
+
+def one_sentence_per_line(text, indent_following_lines=''):
+  if not needs_splitting(text):
+    sentence_cache.skipped += 1
+    return text
+  text, mask = mask_deferred_refs(text)
+  result = sentence_cache.get(text, indent_following_lines)
+  if result is None:
+    start = time.perf_counter()
+    result = segment_sentences(text, indent_following_lines)
+    sentence_cache.add(text, indent_following_lines, result, time.perf_counter() - start)
+  return unmask_deferred_refs(result, mask)
+
+
 # RST Helpers =================================================================
 
-code_regex = {
-  'omg-idl': re.compile(r'@key|@topic|module DDS|interface|enum|boolean|struct'),
-  'ini': re.compile('\[common]|\[transport|\[domain|\[config'),
-  'xml': re.compile('xml version="1.0"'),
-  'cpp': re.compile('int main|#include.*\.h[">]|int ACE_TMAIN|_var |OpenDDS::DCPS::|std::|\w->'),
-  'java': re.compile('public static void main|System.out.println|Helper|null'),
-  'bash': re.compile('\$(ACE|DDS)'),
-  'doscon': re.compile('\%(ACE|DDS)'),
-  'mpc': re.compile('project[\(:]'),
-}
+# Kept for later conversions, which set their own priority
+code_classifier = code_language.CodeClassifier()
+
 def write_code(out, lines):
   # Detect
   code = '\n'.join(lines)
-  names = []
-  for name, regex in code_regex.items():
-    if regex.search(code):
-      names.append(name)
-  # if None not in names:
-  #   if len(names) == 0:
-  #     print('Could not find name for:')
-  #     print('=' * 80)
-  #     print(code)
-  #     print('=' * 80)
-  name = None
-  if names:
-    if len(names) > 1:
-      print('Matched more than one name for code:', ', '.join(names), file=sys.stderr)
-      print('=' * 80, file=sys.stderr)
-      print(code, file=sys.stderr)
-      print('=' * 80, file=sys.stderr)
-      sys.exit(1)
-    name = names[0]
+  name, scores = code_classifier.classify(code)
+  # if name is None:
+  #   print('Could not find name for:')
+  #   print('=' * 80)
+  #   print(code)
+  #   print('=' * 80)
+  if len(scores) > 1:
+    print('Matched more than one name for code: {}, using {}'.format(
+      ', '.join('{} ({})'.format(k, v) for k, v in scores.items()), name), file=sys.stderr)
+    print('=' * 80, file=sys.stderr)
+    print(code, file=sys.stderr)
+    print('=' * 80, file=sys.stderr)
 
   # Write
   if name is None:
@@ -130,61 +517,6 @@ def get_header(title, level):
   return rv + '\n'
 
 
-def fix_monospace(raw_string, last_char_arg=None):
-  tick_count = 0
-  string = ''
-  keep_back = None
-  state = 0
-  for c in raw_string:
-    last_char = string[-1] if string else last_char_arg
-    if c == '`':
-      if state == 0: # Left of ``..``
-        if tick_count == 1: # Almost Inside ``..``
-          if last_char and last_char.isalnum():
-            string += ' '
-          string += '``'
-          state = 1
-          tick_count = 0
-        else:
-          tick_count += 1
-        continue
-      elif state == 1: # Inside ``..``
-        if tick_count == 1: # Almost Outside ``..``
-          keep_back = '``'
-          state = 2
-          tick_count = 0
-        else:
-          tick_count += 1
-        continue
-      elif state == 2: # After ``..``
-        if tick_count == 1: # Almost Outside ``..``
-          tick_count = 0
-          keep_back = None
-          state = 1
-        else:
-          tick_count += 1
-        continue
-    else:
-      if state == 2: # After ``
-        string += keep_back
-        keep_back = None
-        if c.isalnum():
-          string += ' '
-        state = 0
-      else:
-        if keep_back:
-          string += keep_back
-          keep_back = None
-        string += '`' * tick_count
-        tick_count = 0
-    string += c
-  if keep_back:
-    string += keep_back
-  if tick_count:
-    string += '`' * tick_count
-  return string
-
-
 def write_grid_table(rows, out):
   new_rows = []
   for row in rows:
@@ -201,7 +533,7 @@ def write_grid_table(rows, out):
     if col_count is None:
       col_count = count
     elif count != col_count:
-      sys.exit('Invalid Table')
+      raise ConversionError('Invalid Table')
 
   # Split Lines in Cells, Get Max Row Height
   row_max = []
@@ -289,15 +621,11 @@ def write_table(rows, out):
   write_list_table(rows, out)
 
 
-def inline_markup(string, what):
-  if len(string) == 0:
-    return ''
-  return '{0}{1}{0}'.format(
-    {
-     'monospace': '``',
-     'italic': '*',
-     'bold': '**',
-    }[what], string.strip())
+inline_markers = {
+  'monospace': '``',
+  'italic': '*',
+  'bold': '**',
+}
 
 
 def paragraph_break(text):
@@ -347,6 +675,8 @@ parent_style_name_attr = style_attr('parent-style-name')
 style_display_name_attr = style_attr('display-name')
 style_internal_name_attr = style_attr('name')
 
+body_qname = ('urn:oasis:names:tc:opendocument:xmlns:office:1.0', 'body')
+
 
 def find_node_where(node, cond):
   if cond(node):
@@ -373,58 +703,45 @@ def get_style_node(name):
     return None
 
 
-class Style:
-  def check_node(self, doc, name):
-    node = get_style_node(name)
-    if node is None:
-      return
-    parent = get_attr(node, parent_style_name_attr)
-    if parent is not None:
-      self.check_node(doc, parent)
+preheader_re = re.compile(r"PreHeader (\d+)")
 
-    for child in node.childNodes:
-      if child.qname not in self.props:
-        self.props[child.qname] = dict()
-      self.props[child.qname].update(child.attributes)
 
-  def __init__(self, info, node=None, name=None):
-    self.props = {}
-    self.inline = None
-    if node is None != name is None:
-      raise ValueError('Invalid Arguments')
-    self.name = get_style_name(node) if node is not None else name
-    if self.name is None:
-      return
-    if self.name == 'Note': # Ignore Italics on Notes
-      return
-    self.check_node(info.doc, self.name)
+def get_inline(props):
+  inline = None
+  for prop_group in props.values():
+    def get_prop(prop_key):
+      return prop_group.get(prop_key, '').lower()
+
+    font_family = get_prop(
+      ('urn:oasis:names:tc:opendocument:xmlns:xsl-fo-compatible:1.0', 'font-family'))
+    font_name = get_prop(style_attr('font-name'))
+    font_pitch = get_prop(style_attr('font-pitch'))
+    font_style = get_prop(
+      ('urn:oasis:names:tc:opendocument:xmlns:xsl-fo-compatible:1.0', 'font-style'))
+    font_style_name = get_prop(style_attr('font-style-name'))
+    font_weight = get_prop(
+      ('urn:oasis:names:tc:opendocument:xmlns:xsl-fo-compatible:1.0', 'font-weight'))
 
-    for prop_group in self.props.values():
-      def get_prop(prop_key):
-        return prop_group.get(prop_key, '').lower()
+    if font_style == 'italic':
+      inline = 'italic'
 
-      font_family = get_prop(
-        ('urn:oasis:names:tc:opendocument:xmlns:xsl-fo-compatible:1.0', 'font-family'))
-      font_name = get_prop(style_attr('font-name'))
-      font_pitch = get_prop(style_attr('font-pitch'))
-      font_style = get_prop(
-        ('urn:oasis:names:tc:opendocument:xmlns:xsl-fo-compatible:1.0', 'font-style'))
-      font_style_name = get_prop(style_attr('font-style-name'))
-      font_weight = get_prop(
-        ('urn:oasis:names:tc:opendocument:xmlns:xsl-fo-compatible:1.0', 'font-weight'))
+    if 'bold' in (font_style_name, font_weight):
+      inline = 'bold'
 
-      if font_style == 'italic':
-        self.inline = 'italic'
+    if 'mono' in font_family or 'mono' in font_name or 'courier' in font_name or \
+        font_pitch == 'fixed':
+      inline = 'monospace'
+  return inline
 
-      if 'bold' in (font_style_name, font_weight):
-        self.inline = 'bold'
 
-      if 'mono' in font_family or 'mono' in font_name or 'courier' in font_name or \
-          font_pitch == 'fixed':
-        self.inline = 'monospace'
+class Style:
+  created = 0
 
-    if node and node.nodeType == element.Node.ELEMENT_NODE and node.qname[1] == 'h':
-      self.inline = None
+  def __init__(self, name=None, props=None, inline=None):
+    Style.created += 1
+    self.name = name
+    self.props = {} if props is None else props
+    self.inline = inline
 
   def __bool__(self):
     return self.name is not None
@@ -433,36 +750,220 @@ class Style:
     return '<{} inline={}>'.format(repr(self.name), repr(self.inline))
 
 
-def node_has_style(node, style_name):
-  current_name = get_style_name(node)
-  # print(style_name, current_name)
-  while current_name is not None:
-    # print(' ', current_name)
-    current_style = doc.getStyleByName(current_name)
-    display_name = get_attr(current_style, style_display_name_attr)
-    if display_name is not None:
-      if isinstance(style_name, re.Pattern):
-        m = style_name.match(display_name)
+class StyleResolver:
+  # Flattens the parent chain of each style name and classifies it once, then
+  # hands out the same Style object to every node that uses that name.
+  def __init__(self, doc):
+    self.props = {}
+    self.styles = {}
+    self.ancestry = {}
+    self.preheader_levels = {}
+    self.hits = 0
+    self.misses = 0
+
+    # Level kinds of every list style (including automatic ones) by name. Like
+    # the document scan this replaces, the first node with the name wins.
+    self.list_styles = {}
+    for node in doc.topnode.childNodes:
+      if node.qname != body_qname:
+        self.index_list_styles(node)
+
+  def index_list_styles(self, node):
+    if node.nodeType != element.Node.ELEMENT_NODE:
+      return
+    name = get_attr(node, style_internal_name_attr)
+    if name is not None and name not in self.list_styles:
+      self.list_styles[name] = [child.qname[1] for child in node.childNodes]
+    for child in node.childNodes:
+      self.index_list_styles(child)
+
+  def is_numbered_list(self, name, list_level):
+    levels = self.list_styles.get(name, None)
+    if levels is None:
+      return False
+    return levels[list_level - 1] == 'list-level-style-number'
+
+  def get_props(self, name):
+    props = self.props.get(name, None)
+    if props is None:
+      props = {}
+      node = get_style_node(name)
+      if node is not None:
+        parent = get_attr(node, parent_style_name_attr)
+        if parent is not None:
+          for k, v in self.get_props(parent).items():
+            props[k] = dict(v)
+        for child in node.childNodes:
+          if child.qname not in props:
+            props[child.qname] = dict()
+          props[child.qname].update(child.attributes)
+      self.props[name] = props
+    return props
+
+  def get_ancestry(self, name):
+    # Display names of the style and all its parents, nearest first
+    if name is None:
+      return ()
+    ancestry = self.ancestry.get(name, None)
+    if ancestry is None:
+      ancestry = ()
+      node = get_style_node(name)
+      if node is not None:
+        display_name = get_attr(node, style_display_name_attr)
+        if display_name is not None:
+          ancestry = (display_name,)
+        ancestry += self.get_ancestry(get_attr(node, parent_style_name_attr))
+      self.ancestry[name] = ancestry
+    return ancestry
+
+  def get_preheader_level(self, name):
+    if name not in self.preheader_levels:
+      level = None
+      for display_name in self.get_ancestry(name):
+        m = preheader_re.match(display_name)
         if m:
-          return m
-      elif display_name == style_name:
-        return True
-    current_name = get_attr(current_style, parent_style_name_attr)
+          level = int(m.group(1))
+          break
+      self.preheader_levels[name] = level
+    return self.preheader_levels[name]
+
+  def get(self, name, header=False):
+    key = (name, header)
+    style = self.styles.get(key, None)
+    if style is not None:
+      self.hits += 1
+      return style
+    self.misses += 1
+    if name is None:
+      style = Style()
+    elif name == 'Note': # Ignore Italics on Notes
+      style = Style(name)
+    else:
+      props = self.get_props(name)
+      style = Style(name, props, None if header else get_inline(props))
+    self.styles[key] = style
+    return style
+
+  def get_for_node(self, node):
+    return self.get(get_style_name(node),
+      header=node.nodeType == element.Node.ELEMENT_NODE and node.qname[1] == 'h')
+
+  def __repr__(self):
+    return '<StyleResolver: {} styles, {} hits, {} misses>'.format(
+      len(self.styles), self.hits, self.misses)
+
+
+# For batches, style resolvers of earlier conversions by the hash of the
+# document's style tables. Hashing them takes a while, so it's only done if
+# asked for.
+shared_style_resolvers = {}
+
+office_ns = 'urn:oasis:names:tc:opendocument:xmlns:office:1.0'
+style_table_qnames = {(office_ns, name)
+  for name in ('font-face-decls', 'styles', 'automatic-styles', 'master-styles')}
+
+def hash_style_node(hasher, node):
+  # Hashes names instead of the XML, which has namespace prefixes that can
+  # depend on what other documents were loaded.
+  if node.nodeType == element.Node.ELEMENT_NODE:
+    hasher.update(repr((node.qname, sorted(
+      (k, str(v)) for k, v in node.attributes.items()))).encode('utf-8'))
+    for child in node.childNodes:
+      hash_style_node(hasher, child)
+    hasher.update(b'\0')
+  else:
+    hasher.update(repr(str(node)).encode('utf-8'))
+
+def get_style_tables_hash(doc):
+  hasher = hashlib.sha256()
+  for node in doc.topnode.childNodes:
+    if node.qname in style_table_qnames:
+      hash_style_node(hasher, node)
+  return hasher.digest()
+
+def get_shared_style_resolver(doc):
+  key = get_style_tables_hash(doc)
+  styles = shared_style_resolvers.get(key, None)
+  if styles is None:
+    styles = shared_style_resolvers[key] = StyleResolver(doc)
+  else:
+    print('Reusing the styles of an earlier document with the same style tables')
+    styles.hits = 0
+    styles.misses = 0
+  return styles
+
+
+def node_has_style(info, node, style_name):
+  for display_name in info.styles.get_ancestry(get_style_name(node)):
+    if isinstance(style_name, re.Pattern):
+      m = style_name.match(display_name)
+      if m:
+        return m
+    elif display_name == style_name:
+      return True
   return None
 
 
 # Dump ========================================================================
 
-dump_path = Path('dump')
-dump_path.mkdir(exist_ok=True)
+# Dumps are only written if asked for with --dump. They're written as they
+# are generated, gzipped if --dump-gzip is passed.
+
+dump_path = None # Set by Converter.convert
+
+def open_dump(name):
+  if args.dump_gzip:
+    return gzip.open(str(dump_path / (name + '.gz')), 'wt', encoding='utf-8')
+  return (dump_path / name).open('w')
 
 # Dump XML
-with (dump_path / 'main.xml').open('w') as f:
-  buf = io.StringIO()
-  doc.topnode.toXml(0, buf)
-  import xml.dom.minidom
-  print(xml.dom.minidom.parseString(buf.getvalue()).toprettyxml(), file=f)
-  buf.close()
+def xml_data(string):
+  # Same as xml.dom.minidom, what toprettyxml would write after toXml and
+  # parsing again.
+  return string.replace('&', '&amp;').replace('<', '&lt;'). \
+    replace('"', '&quot;').replace('>', '&gt;')
+
+def get_pretty_xml_children(node):
+  # Text as it would be after going through toXml and an XML parser: empty
+  # text is dropped, adjacent text is merged and line endings are normalized.
+  children = []
+  for child in node.childNodes:
+    if child.nodeType == element.Node.TEXT_NODE:
+      data = _handle_unrepresentable(str(child)).replace('\r\n', '\n').replace('\r', '\n')
+      if not data:
+        continue
+      if children and isinstance(children[-1], str):
+        children[-1] += data
+      else:
+        children.append(data)
+    else:
+      children.append(child)
+  return children
+
+def write_pretty_xml(node, indent, f, level=0):
+  # Writes the same thing as the toprettyxml of the minidom of the node's
+  # toXml, without making either of them.
+  f.write(indent + '<' + node.tagName)
+  if level == 0:
+    for namespace, prefix in node.namespaces.items():
+      f.write(' xmlns:' + prefix + '="' + xml_data(_handle_unrepresentable(str(namespace))) + '"')
+  for qname, value in node.attributes.items():
+    value = _handle_unrepresentable(str(value)).replace('\t', ' ')
+    f.write(' ' + node.get_nsprefix(qname[0]) + ':' + qname[1] + '="' + xml_data(value) + '"')
+  children = get_pretty_xml_children(node)
+  if not children:
+    f.write('/>\n')
+  elif len(children) == 1 and isinstance(children[0], str):
+    f.write('>' + xml_data(children[0]) + '</' + node.tagName + '>\n')
+  else:
+    f.write('>\n')
+    child_indent = indent + '\t'
+    for child in children:
+      if isinstance(child, str):
+        f.write(xml_data(child_indent + child + '\n'))
+      else:
+        write_pretty_xml(child, child_indent, f, level + 1)
+    f.write(indent + '</' + node.tagName + '>\n')
 
 # Dump Nodes
 def dump_node(node, indent, f):
@@ -484,41 +985,406 @@ def dump_node_exit(info, node, message):
   dump_node(node, '  ', sys.stderr)
   print('=' * 80, file=sys.stderr)
   print('Info stack (First item is top):', file=sys.stderr)
-  for item in reversed(info.data):
+  for item in reversed(info.frame_dicts()):
     print(' -', repr(item), file=sys.stderr)
-  sys.exit('Exiting')
+  raise ConversionError(message)
+
+def dump_document(doc):
+  if 'xml' in args.dump:
+    with open_dump('main.xml') as f:
+      f.write('<?xml version="1.0" ?>\n')
+      write_pretty_xml(doc.topnode, '', f)
+      f.write('\n')
+  if 'nodes' in args.dump:
+    with open_dump('nodes') as f:
+      dump_node(doc.topnode, '', f)
 
-nodes_path = dump_path / 'nodes'
-with nodes_path.open('w') as f:
-  dump_node(doc.topnode, '', f)
+
+# Output Files ================================================================
+
+# Files are only replaced if what would be written is different, so their
+# modification times tell Sphinx and anything else looking at them what
+# actually changed. New files are written next to the old one and renamed
+# over it, so a partly written file is never seen.
+
+def get_file_stamp(path):
+  try:
+    stat = path.stat()
+  except FileNotFoundError:
+    return None # It can be missing for a moment while it's being saved
+  return stat.st_mtime_ns, stat.st_size
+
+
+def get_temp_path(path):
+  return path.with_name('.{}.{}.tmp'.format(path.name, os.getpid()))
+
+
+def replace_file(path, data):
+  temp_path = get_temp_path(path)
+  temp_path.write_bytes(data)
+  os.replace(str(temp_path), str(path))
+
+
+def update_file(path, data):
+  # Returns if the file was written
+  stamp = get_file_stamp(path)
+  if stamp is not None and stamp[1] == len(data) and path.read_bytes() == data:
+    return False
+  replace_file(path, data)
+  return True
+
+
+# Runs of empty lines are squeezed into one
+extra_blank_lines_re = re.compile(r'(^|\n)\n+(?=\n)')
+
+def write_page(path, text):
+  if update_file(path, extra_blank_lines_re.sub(r'\1', text).encode('utf-8')):
+    profiler.counters['pages_written'] += 1
+  else:
+    profiler.counters['pages_unchanged'] += 1
+
+
+def remove_stale_files(path, names, manifest_path):
+  # Removes the files in path that the last conversion wrote and this one,
+  # which wrote names, didn't. Like sync_directory, the manifest has what was
+  # written, so anything else in path is left alone.
+  manifest = []
+  if manifest_path.is_file():
+    manifest = json.loads(manifest_path.read_text())
+  for name in manifest:
+    file_path = path / name
+    if name not in names and file_path.is_file() and not file_path.is_symlink():
+      print('Removing', file_path)
+      file_path.unlink()
+  manifest_path.parent.mkdir(parents=True, exist_ok=True)
+  manifest_path.write_text(json.dumps(sorted(names), indent=1))
+
+
+def remove_stale_pages(path, pages):
+  # Removes pages left by earlier conversions that this one didn't write
+  filenames = {filename for name, filename in pages}
+  filenames.add('index.rst')
+  remove_stale_files(path, filenames, get_manifest_path('pages', path))
+
+
+def get_file_hash(path):
+  hasher = hashlib.sha256()
+  with path.open('rb') as f:
+    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+      hasher.update(chunk)
+  return hasher.hexdigest()
+
+
+def sync_directory(src, dst, manifest_path):
+  # Copies the files in src to dst, only replacing the ones that are
+  # different. The manifest has the hash, modification time and size of each
+  # file as it was last copied to dst, so files there that still have the
+  # same time and size don't have to be read again. Files that were copied
+  # before but aren't in src anymore are removed, anything else in dst is
+  # left alone.
+  manifest = {}
+  if manifest_path.is_file():
+    manifest = json.loads(manifest_path.read_text())
+  new_manifest = {}
+  copied = unchanged = removed = 0
+  for src_path in sorted(src.rglob('*')):
+    if not src_path.is_file() or src_path.name.endswith('.tmp'):
+      continue
+    name = src_path.relative_to(src).as_posix()
+    dst_path = dst / name
+    data = src_path.read_bytes()
+    digest = hashlib.sha256(data).hexdigest()
+    stamp = get_file_stamp(dst_path)
+    entry = manifest.get(name, None)
+    if stamp is None:
+      current = None
+    elif entry is not None and entry[1:] == list(stamp):
+      current = entry[0]
+    else:
+      current = get_file_hash(dst_path)
+    if current == digest:
+      unchanged += 1
+    else:
+      dst_path.parent.mkdir(parents=True, exist_ok=True)
+      replace_file(dst_path, data)
+      stamp = get_file_stamp(dst_path)
+      copied += 1
+    new_manifest[name] = [digest] + list(stamp)
+  for name in manifest:
+    if name not in new_manifest and (dst / name).is_file():
+      (dst / name).unlink()
+      removed += 1
+  manifest_path.parent.mkdir(parents=True, exist_ok=True)
+  manifest_path.write_text(json.dumps(new_manifest, indent=1))
+  print('Synced {} to {}: {} copied, {} unchanged, {} removed'.format(
+    src, dst, copied, unchanged, removed))
+
+
+def get_manifest_path(kind, path):
+  return Path(args.cache_dir) / kind / '{}.json'.format(
+    hashlib.sha1(str(path.resolve()).encode('utf-8')).hexdigest()[:16])
+
+
+def get_sync_manifest_path(dst):
+  return get_manifest_path('sync', dst)
 
 
 # Convert =====================================================================
 
-export_path = Path('devguide')
-export_path.mkdir(exist_ok=True)
+# Set by Converter.convert
+odt_path = None
+export_path = None
+images_path = None
+images = {}
 
 # Images
-images_path = export_path / 'images'
-images_path.mkdir(exist_ok=True)
-for k, v in doc.Pictures.items():
-  assert(v[0] == 1)
-  path = images_path / Path(k).name
-  if path.suffixes == ['.png']:
-    path.write_bytes(v[1])
+image_threads = 4
+image_chunk_size = 64 * 1024
+
+def copy_image(name, path):
+  # Copies a picture straight from the ODT archive in chunks, unless the file
+  # is already there with the same size and CRC as the archive has for it.
+  # Returns if it was written and its size.
+  with zipfile.ZipFile(odt_path) as z:
+    zip_info = z.getinfo(name)
+    if path.is_file() and path.stat().st_size == zip_info.file_size:
+      crc = 0
+      with path.open('rb') as f:
+        for chunk in iter(lambda: f.read(image_chunk_size), b''):
+          crc = zlib.crc32(chunk, crc)
+      if crc == zip_info.CRC:
+        return False, zip_info.file_size
+    temp_path = get_temp_path(path)
+    with z.open(zip_info) as src, temp_path.open('wb') as dst:
+      shutil.copyfileobj(src, dst, image_chunk_size)
+    os.replace(str(temp_path), str(path))
+    return True, zip_info.file_size
+
+png_signature = b'\x89PNG\r\n\x1a\n'
+
+def get_png_size(header):
+  # Width and height from the IHDR chunk, which always comes first
+  if len(header) < 24 or header[:8] != png_signature or header[12:16] != b'IHDR':
+    return None
+  return int.from_bytes(header[16:20], 'big'), int.from_bytes(header[20:24], 'big')
+
+def get_images(doc):
+  # Picks a file name for each PNG the document uses. Pictures with the same
+  # contents get the same file, named after the header before where it's
+  # first used. Returns a dict of the picture names in the archive to dicts
+  # with the file name, the picture to copy it from, and its size if it
+  # could be read.
+  images = {}
+  by_hash = {}
+  used_names = set()
+  header = None
+  with zipfile.ZipFile(odt_path) as z:
+    stack = [doc.body]
+    while stack:
+      node = stack.pop()
+      if isinstance(node, tuple):
+        # Done with the header, so images after this are under it. Images
+        # inside the header, like figures that ended up in one, aren't.
+        header = node[0]
+        continue
+      if node.nodeType != element.Node.ELEMENT_NODE:
+        continue
+      kind = node.qname[1]
+      if kind == 'h':
+        stack.append((node,))
+      elif kind == 'image':
+        mime = node.attributes.get(
+          ('urn:oasis:names:tc:opendocument:xmlns:drawing:1.0', 'mime-type'), None)
+        href = node.attributes.get(('http://www.w3.org/1999/xlink', 'href'), None)
+        if mime != 'image/png' or not href or href in images:
+          continue
+        hasher = hashlib.sha256()
+        with z.open(href) as f:
+          first = f.read(image_chunk_size)
+          hasher.update(first)
+          for chunk in iter(lambda: f.read(image_chunk_size), b''):
+            hasher.update(chunk)
+        digest = hasher.digest()
+        image = by_hash.get(digest, None)
+        if image is None:
+          base = slugify(str(header)) if header is not None else ''
+          base = base or 'image'
+          name = base + '.png'
+          number = 1
+          while name in used_names:
+            number += 1
+            name = '{}-{}.png'.format(base, number)
+          used_names.add(name)
+          image = dict(name=name, source=href, size=get_png_size(first))
+          by_hash[digest] = image
+        images[href] = image
+      stack.extend(reversed(node.childNodes))
+  return images
+
+def extract_images(doc, images):
+  for name in doc.Pictures:
+    if Path(name).suffixes != ['.png']:
+      print('Warning: Not copying unsupported image format:', name, file=sys.stderr)
+  image_copies = {image['name']: image['source'] for image in images.values()}
+  remove_stale_files(images_path, image_copies, get_manifest_path('images', images_path))
+  image_copies = [(source, images_path / name) for name, source in image_copies.items()]
+  with concurrent.futures.ThreadPoolExecutor(image_threads) as pool:
+    image_results = list(pool.map(lambda copy: copy_image(*copy), image_copies))
+  print('Images: {} written ({} bytes), {} unchanged ({} bytes)'.format(
+    sum(1 for written, size in image_results if written),
+    sum(size for written, size in image_results if written),
+    sum(1 for written, size in image_results if not written),
+    sum(size for written, size in image_results if not written)))
 
 trailing_whitespace_re = re.compile(r"[^\S\n]+\n")
+line_end_space_re = re.compile(r"[^\S\n]+\Z")
+
+class TextBuffer:
+  # What buffer Outs write to. Keeps the fragments and only joins them once
+  # the value is needed. Nested get_text calls and inline styled nodes write
+  # into the buffer of the paragraph they're in, starting from a mark, instead
+  # of into buffers of their own. get_text takes its text back out with take,
+  # inline markup is added to the fragments in place.
+  __slots__ = ('fragments', 'marks')
+  created = 0
+
+  def __init__(self):
+    self.fragments = []
+    self.marks = [] # Indexes of fragments, innermost last
+    TextBuffer.created += 1
+
+  def write(self, string):
+    if string:
+      self.fragments.append(string)
+
+  def getvalue(self):
+    if len(self.fragments) > 1:
+      self.fragments = [''.join(self.fragments)]
+    return self.fragments[0] if self.fragments else ''
+
+  def close(self):
+    self.fragments = None
+
+  def mark(self):
+    # Returns the depth of the new mark for insert
+    self.marks.append(len(self.fragments))
+    return len(self.marks) - 1
+
+  def take(self):
+    # Removes the text from the innermost mark on and returns it
+    start = self.marks.pop()
+    text = ''.join(self.fragments[start:])
+    del self.fragments[start:]
+    return text
+
+  def release(self):
+    # Removes the innermost mark, leaving the text after it
+    self.marks.pop()
+
+  def insert(self, depth, string):
+    # Writes string where the text from the mark at depth starts, so it ends
+    # up before that text and the text of the marks inside it.
+    if string:
+      self.fragments.insert(self.marks[depth], string)
+      for i in range(depth, len(self.marks)):
+        self.marks[i] += 1
+
+  def wrap_lines(self, what):
+    # Strips each line of the text from the innermost mark on and puts the
+    # markers for what around it, leaving empty lines and images and their
+    # options alone. Works on the fragments, without joining the text.
+    start = self.marks[-1]
+    lines = [[]]
+    for fragment in self.fragments[start:]:
+      parts = fragment.split('\n')
+      lines[-1].append(parts[0])
+      lines.extend([part] for part in parts[1:])
+    fragments = []
+    in_image = False
+    for index, pieces in enumerate(lines):
+      if index:
+        fragments.append('\n')
+      head = ''
+      for piece in pieces:
+        head += piece
+        if len(head) >= len('.. image::'):
+          break
+      in_image = head.startswith('.. image::') or (in_image and head.startswith('   :'))
+      if in_image:
+        if index + 1 < len(lines):
+          strip_pieces(pieces, left=False) # Like trailing_whitespace_re
+        fragments.extend(pieces)
+      elif any(pieces):
+        strip_pieces(pieces)
+        fragments.append(inline_markers[what])
+        fragments.extend(pieces)
+        fragments.append(inline_markers[what])
+    self.fragments[start:] = [fragment for fragment in fragments if fragment]
+
+  def paragraph_break(self):
+    # Like paragraph_break on the text from the innermost mark on
+    start = self.marks[-1]
+    end = ''
+    for fragment in reversed(self.fragments[start:]):
+      end = fragment + end
+      if len(end) >= 2:
+        break
+    if end and not end.endswith('\n\n'):
+      if end.endswith('\n'):
+        self.fragments.append('\n')
+        return
+      # Like trailing_whitespace_re once the break is written
+      while len(self.fragments) > start:
+        fragment = line_end_space_re.sub('', self.fragments[-1])
+        if fragment:
+          self.fragments[-1] = fragment
+          break
+        del self.fragments[-1]
+      self.fragments.append('\n\n')
+
+
+def strip_pieces(pieces, left=True):
+  # Strips the text pieces make up together in place, like str.strip
+  while pieces and left:
+    pieces[0] = pieces[0].lstrip()
+    if pieces[0]:
+      break
+    del pieces[0]
+  while pieces:
+    pieces[-1] = pieces[-1].rstrip()
+    if pieces[-1]:
+      break
+    del pieces[-1]
+
+
+class InlineSpan:
+  # Stands in for the Out an inline styled node is written to for what has
+  # to go before its markup instead of inside it, like references. The text
+  # of the node is in the same buffer from the mark at depth.
+  def __init__(self, out, depth):
+    self.out = out
+    self.depth = depth
+
+  def write(self, string):
+    if '\n' in string:
+      string = trailing_whitespace_re.sub(r'\n', string)
+    self.out.buffer().insert(self.depth, string)
+
 
 class Out:
   def __init__(self):
     self.out = None
     self.path = None
+    self.page = None
     self.pages = []
-    self.newline_count = 0
-    self.keep_back = None
-    self.tilde_count = 0
-    self.inline_monospace_state = 0
-    self.last_char = None
+    self.monospace = None
+    # Pages by path to write later instead of when they're closed, if set
+    self.held_pages = None
+    # If set, what's written to pages is kept as it was written, as a list of
+    # (path, writes), for write_deferred to write once the sentence
+    # placeholders can be replaced. The monospace fixer has to see the text
+    # that replaces them.
+    self.deferred_writes = None
 
   @staticmethod
   def filename(name, ext='.rst'):
@@ -535,87 +1401,50 @@ class Out:
   def open(self, name=None):
     self.close()
     if name is None:
-      self.out = io.StringIO()
+      self.out = TextBuffer()
     else:
+      if self.monospace is None:
+        self.monospace = MonospaceFixer()
       filename = self.filename(name)
       self.pages.append((name, filename))
-      self.path = export_path / filename
-      self.out = self.path.open('w')
+      self.open_page(export_path / filename)
+
+  def buffer(self):
+    # The TextBuffer written to, or None for pages
+    return self.out if self.path is None else None
+
+  def open_page(self, path):
+    self.path = path
+    if self.deferred_writes is not None:
+      self.out = []
+      self.deferred_writes.append((path, self.out))
+      return
+    # Written out when it's done, if it changed
+    self.page = io.StringIO()
+    self.out = self.page
+    if profiler.enabled:
+      self.out = TimedFile(self.out)
 
   def write(self, *args, **kwargs):
     if self.out is not None:
       end = kwargs.get('end', '')
       sep = kwargs.get('sep', ' ')
       raw_string = sep.join(args) + end
+      if self.path and self.deferred_writes is not None:
+        self.out.append(raw_string)
+        return
       if self.path:
-        string = ''
-        for c in raw_string:
-          last_char = string[-1] if string else self.last_char
-          if c == '\n':
-            if self.keep_back:
-              string += self.keep_back
-              self.keep_back = None
-            string += '`' * self.tilde_count
-            self.tilde_count = 0
-            self.inline_monospace_state = 0
-            if self.newline_count == 2:
-              self.newline_count = 0
-              continue
-            self.newline_count += 1
-          elif c == '`':
-            self.newline_count = 0
-            if self.inline_monospace_state == 0: # Left of ``..``
-              if self.tilde_count == 1: # Almost Inside ``..``
-                if last_char.isalnum():
-                  string += ' '
-                string += '``'
-                self.inline_monospace_state = 1
-                self.tilde_count = 0
-              else:
-                self.tilde_count += 1
-              continue
-            elif self.inline_monospace_state == 1: # Inside ``..``
-              if self.tilde_count == 1: # Almost Outside ``..``
-                self.keep_back = '``'
-                self.inline_monospace_state = 2
-                self.tilde_count = 0
-              else:
-                self.tilde_count += 1
-              continue
-            elif self.inline_monospace_state == 2: # After ``..``
-              if self.tilde_count == 1: # Almost Outside ``..``
-                self.tilde_count = 0
-                self.keep_back = None
-                self.inline_monospace_state = 1
-              else:
-                self.tilde_count += 1
-              continue
-          else:
-            if self.inline_monospace_state == 2: # After ``
-              string += self.keep_back
-              self.keep_back = None
-              if c.isalnum():
-                string += ' '
-              self.inline_monospace_state = 0
-            else:
-              if self.keep_back:
-                string += self.keep_back
-                self.keep_back = None
-              string += '`' * self.tilde_count
-              self.tilde_count = 0
-            self.newline_count = 0
-          string += c
+        string = self.monospace.feed(raw_string)
       else:
         string = raw_string
 
-      if string:
-        self.last_char = string[-1]
-
       # indent = kwargs.get('indent', None)
       # if indent is not None:
       #   string = indent + re.sub(r'\n', r'\n' + indent, string)
 
-      print(trailing_whitespace_re.sub(r'\n', string), end='', file=self.out)
+      if '\n' in string:
+        string = trailing_whitespace_re.sub(r'\n', string)
+      self.out.write(string)
 
   def writeln(self, *args, **kwargs):
     self.write(*args, **kwargs, end='\n')
@@ -625,11 +1454,32 @@ class Out:
     if self.out is not None:
       if self.path is None:
         rv = self.out.getvalue()
-      self.out.close()
+        self.out.close()
+      elif self.deferred_writes is None:
+        text = self.page.getvalue()
+        self.out.close()
+        if self.held_pages is not None:
+          self.held_pages[self.path] = text
+        else:
+          write_page(self.path, text)
       self.out = None
     self.path = None
+    self.page = None
     return rv
 
+  def write_deferred(self, sentences):
+    # Writes the pages kept in deferred_writes, replacing the placeholders
+    # from SentenceStage.defer with sentences.
+    deferred_writes = self.deferred_writes
+    self.deferred_writes = None
+    if self.monospace is None:
+      self.monospace = MonospaceFixer()
+    for path, writes in deferred_writes:
+      self.open_page(path)
+      for raw_string in writes:
+        self.write(sentence_placeholder_re.sub(lambda m: sentences[int(m.group(1))], raw_string))
+      self.close()
+
   def write_directive(self, name, contents, options={}):
     indent = '   '
     self.writeln('..', name)
@@ -640,25 +1490,36 @@ class Out:
       self.writeln(indent + line)
 
   def write_index(self):
-    with (export_path / 'index.rst').open('w') as f:
-      print('''\
+    f = io.StringIO()
+    print('''\
 #########################
 OpenDDS Developer's Guide
 #########################
 
 .. toctree::
 ''', file=f)
-      for name, filename in self.pages:
-        print('   {}'.format(filename), file=f)
+    for name, filename in self.pages:
+      print('   {}'.format(filename), file=f)
+    write_page(export_path / 'index.rst', f.getvalue())
 
   def __repr__(self):
     return '<Out: ' + (str(self.path) if self.path is not None else 'BUFFER') + '>'
 
 
+class Frame:
+  # Keys set on one level of the Info stack. The values themselves are kept
+  # in a stack per key in Info, so lookups don't search through the frames.
+  __slots__ = ('keys',)
+
+  def __init__(self):
+    self.keys = []
+
+
 class Info:
-  def __init__(self, doc, copy_from=None):
+  def __init__(self, doc, copy_from=None, styles=None):
     self.doc = doc
-    self.data = []
+    self.frames = []
+    self.values = {}
     self.all_style_prop_groups = {}
     self.in_preface = True
     if copy_from is None:
@@ -666,31 +1527,63 @@ class Info:
       self.sections = {}
       self.push(section_level=0, section_number=0, section_id="")
       self.references = {}
+      self.styles = styles or StyleResolver(doc)
     else:
       self.sections = copy_from.sections
       self.references = copy_from.references
+      self.styles = copy_from.styles
+    self.saved_styles = set()
     self.prefix = None
     self.footnotes = {}
+    self.ref_info = None
+    self.deferred = None
+    self.used_refs = None
 
   def push(self, **kwargs):
-    self.data.append(dict(**kwargs))
+    self.frames.append(Frame())
+    if kwargs:
+      self.set(**kwargs)
 
   def pop(self):
-    return self.data.pop()
+    frame = self.frames.pop()
+    for key in frame.keys:
+      self.values[key].pop()
+    return frame
 
   def set(self, **kwargs):
-    self.data[-1].update(kwargs)
+    depth = len(self.frames) - 1
+    for key, value in kwargs.items():
+      stack = self.values.get(key, None)
+      if stack is None:
+        stack = self.values[key] = []
+      if stack and stack[-1][0] == depth:
+        stack[-1] = (depth, value)
+      else:
+        stack.append((depth, value))
+        self.frames[depth].keys.append(key)
 
   def get(self, what, otherwise=None, ignore_last=True):
-    if ignore_last:
-      it = self.data[:-1]
-    else:
-      it = self.data
-    for i in reversed(it):
-      if what in i:
-        return i[what]
+    stack = self.values.get(what, None)
+    if stack:
+      depth, value = stack[-1]
+      if not ignore_last or depth != len(self.frames) - 1:
+        return value
+      if len(stack) > 1:
+        return stack[-2][1]
     return otherwise
 
+  def frame_dicts(self):
+    # The stack as a list of dicts, for debugging
+    rv = []
+    for depth, frame in enumerate(self.frames):
+      frame_dict = {}
+      for key in frame.keys:
+        for value_depth, value in self.values[key]:
+          if value_depth == depth:
+            frame_dict[key] = value
+      rv.append(frame_dict)
+    return rv
+
   def getany(self, what, otherwise=None):
     return self.get(what, otherwise, ignore_last=False)
 
@@ -700,19 +1593,22 @@ class Info:
     style = None
     if node.nodeType == element.Node.ELEMENT_NODE and node.qname[1] == 'p':
       if get_style_name(node) == 'P209':
-        style = Style(self, name='Note')
+        style = self.styles.get('Note')
       self.set(paragraph=True)
       if self.get('paragraph'): # Are we nested?
         self.set(ignore_style=False) # If we are, then ignore prior style info
     if self.get('ignore_style', otherwise=False, ignore_last=False):
       style = None
     elif style is None:
-      style = Style(self, node)
+      style = self.styles.get_for_node(node)
     self.set(style=style)
     if style:
       if style.inline is not None:
         self.set(ignore_style=True)
-      # Save Style Options
+      # Save Style Options, once per resolved style
+      if id(style) in self.saved_styles:
+        return
+      self.saved_styles.add(id(style))
       for k, v in style.props.items():
         if k not in self.all_style_prop_groups:
           self.all_style_prop_groups[k] = {}
@@ -724,13 +1620,31 @@ class Info:
   def style(self):
     return self.get('style', ignore_last=False)
 
+  def defer_refs(self, ref_info):
+    # Register sections and references while converting, using ref_info, and
+    # leave placeholders for ref targets that are filled in at the end.
+    self.ref_info = ref_info
+    self.deferred = []
+
+  def ref_target(self, kind, key, resolve=False):
+    if self.deferred is not None and not resolve:
+      self.deferred.append((kind, key))
+      return '\x00{}ref'.format(len(self.deferred) - 1)
+    if kind == 'section':
+      target = self.sections[key]['slug']
+    else:
+      target = self.references[key]
+    if self.used_refs is not None:
+      self.used_refs.append((kind, key, target))
+    return target
+
 
-def convert_child_nodes(info, node, out):
+def convert_child_nodes(info, node, out, children=None):
   # Detect and Write Code Blocks
   code_lines = []
-  for child in node.childNodes:
+  for child in node.childNodes if children is None else children:
     if child.nodeType == element.Node.ELEMENT_NODE and \
-        child.qname[1] == 'p' and Style(info, child).inline == 'monospace':
+        child.qname[1] == 'p' and info.styles.get_for_node(child).inline == 'monospace':
       info.push(ignore_style=True, in_code=True)
       indent = None
       for grandchild in child.childNodes:
@@ -739,7 +1653,7 @@ def convert_child_nodes(info, node, out):
           indent = get_attr(grandchild, c_attr)
           if indent is not None:
             break
-      line = get_text(info, child)
+      line = get_text(info, child, out)
       if indent and line:
         line = ' ' * int(indent) + line.strip()
       code_lines.append(line)
@@ -757,19 +1671,26 @@ def convert_child_nodes(info, node, out):
 dds_root_path_re = re.compile(r"``\$DDS_ROOT/([^`]*)``")
 dds_path_re = re.compile(r"``(dds/[^`]*)``")
 
-def get_text(info, node):
+def get_text(info, node, out=None):
+  # Converts the children of node and returns the text. If out writes to a
+  # buffer, they're converted into that and taken back out instead of into
+  # a buffer of their own.
   nested_get_text = info.getany('nested_get_text', otherwise=False)
   if not nested_get_text:
     info.push(nested_get_text=True)
-  pout = Out()
-  pout.open()
+  pout = out
+  if out is None or out.buffer() is None:
+    pout = Out()
+    pout.open()
+  pout.buffer().mark()
   for child in node.childNodes:
     if child.nodeType == element.Node.ELEMENT_NODE:
       convert_node(info, child, pout)
     elif child.nodeType == element.Node.TEXT_NODE:
       pout.write(str(child))
-  rv = pout.out.getvalue()
-  pout.close()
+  rv = pout.buffer().take()
+  if pout is not out:
+    pout.close()
   if not nested_get_text:
     mod, n = dds_root_path_re.subn(r':ghfile:`\1`', rv)
     if n:
@@ -801,12 +1722,7 @@ def gather_list_items(info, parent_node):
   list_level = info.get('list_level', 0, ignore_last=False)
   list_level += 1
   info.push(list_level=list_level)
-  numbered = False
-  list_style_name = get_style_name(parent_node)
-  list_style = find_node_where(doc.topnode,
-    lambda node: get_attr(node, style_internal_name_attr) == list_style_name)
-  if list_style is not None:
-    numbered = list_style.childNodes[list_level - 1].qname[1] == 'list-level-style-number'
+  numbered = info.styles.is_numbered_list(get_style_name(parent_node), list_level)
   rv = dict(numbered=numbered, items=[])
   for child_node in parent_node.childNodes:
     kind = child_node.qname[1]
@@ -830,17 +1746,20 @@ def has_outline_level(node):
   return False
 
 
-preheader_re = re.compile(r"PreHeader (\d+)")
-
 def get_preface_level(info, node):
   if not info.in_preface:
     return None
   if node.nodeType != element.Node.ELEMENT_NODE or node.qname[1] != 'p':
     return None
-  m = node_has_style(node, preheader_re)
-  if not m:
-    return None
-  return int(m.group(1))
+  return info.styles.get_preheader_level(get_style_name(node))
+
+
+def write_footnotes(info, out):
+  if info.footnotes:
+    out.write('.. rubric:: Footnotes\n\n')
+    for key, text in info.footnotes.items():
+      out.write_directive('[#{}]'.format(key), text)
+    info.footnotes = {}
 
 
 def handle_header(info, node, out=None, preface_level=None):
@@ -857,6 +1776,9 @@ def handle_header(info, node, out=None, preface_level=None):
   for child in node.childNodes:
     if child.nodeType == element.Node.ELEMENT_NODE:
       child_kind = child.qname[1]
+      if info.ref_info is not None and child_kind != 'frame':
+        # Only frames get converted, so register what is in the rest here
+        reference_builder(info.ref_info, child)
       if child_kind == 'frame':
         # Hack for "Figure 1-1  DCPS Conceptual Overview" quagmire which is
         # inside the header node for some unknown reason and otherwise
@@ -878,11 +1800,7 @@ def handle_header(info, node, out=None, preface_level=None):
 
   if out: # in convert_node
     if level == 0:
-      if info.footnotes:
-        out.write('.. rubric:: Footnotes\n\n')
-        for key, text in info.footnotes.items():
-          out.write_directive('[#{}]'.format(key), text)
-        info.footnotes = {}
+      write_footnotes(info, out)
       out.open(name)
       info.prefix = Out.filename(name, ext='')
     out.write('.. _{}:\n\n'.format(info.sections[node.opendds_section_id]['slug']))
@@ -928,46 +1846,68 @@ def handle_header(info, node, out=None, preface_level=None):
     info.sections[section_id] = dict(slug=slug, filename=filename)
 
 
+def register_references(info, node):
+  kind = node.qname[1]
+
+  preface_level = get_preface_level(info, node)
+  if kind == 'h' or preface_level is not None:
+    handle_header(info, node, preface_level=preface_level)
+
+  elif kind == 'bookmark-start':
+    name = must_get_attr(info, node, text_attr('name'))
+    if name in info.references:
+      dump_node_exit(info, node, 'bookmark already in references: ' + kind)
+    prefix = info.get('section_filename', ignore_last=False)
+    info.references[name] = prefixed_ref(prefix, name)
+
+  elif kind == 'sequence':
+    odf_ref_name = node.attributes[text_attr('ref-name')]
+    if odf_ref_name in info.references:
+      dump_node_exit(info, node, 'sequence defintion already in references: ' + kind)
+    prefix = info.get('section_filename', ignore_last=False)
+    info.references[odf_ref_name] = prefixed_ref(prefix, odf_ref_name)
+
+
 def reference_builder(info, node):
   if node is None:
     return
   if node.nodeType == element.Node.ELEMENT_NODE:
-    kind = node.qname[1]
-
-    preface_level = get_preface_level(info, node)
-    if kind == 'h' or preface_level is not None:
-      handle_header(info, node, preface_level=preface_level)
+    register_references(info, node)
+    for child_node in node.childNodes:
+      reference_builder(info, child_node)
 
-    elif kind == 'bookmark-start':
-      name = must_get_attr(info, node, text_attr('name'))
-      if name in info.references:
-        dump_node_exit(info, node, 'bookmark already in references: ' + kind)
-      prefix = info.get('section_filename', ignore_last=False)
-      info.references[name] = prefixed_ref(prefix, name)
 
-    elif kind == 'sequence':
-      odf_ref_name = node.attributes[text_attr('ref-name')]
-      if odf_ref_name in info.references:
-        dump_node_exit(info, node, 'sequence defintion already in references: ' + kind)
-      prefix = info.get('section_filename', ignore_last=False)
-      info.references[odf_ref_name] = prefixed_ref(prefix, odf_ref_name)
+deferred_ref_re = re.compile(r'\x00(\d+)ref')
 
-    for child_node in node.childNodes:
-      reference_builder(info, child_node)
+def patch_deferred_refs(info, out):
+  # Replace the placeholders left by Info.ref_target in single pass mode now
+  # that all the sections and references are known, then write the pages
+  # held by out.
+  targets = [info.ref_target(kind, key, resolve=True) for kind, key in info.deferred]
+  for path, contents in out.held_pages.items():
+    write_page(path, deferred_ref_re.sub(lambda m: targets[int(m.group(1))], contents))
+  out.held_pages = None
 
 
 def convert_node(info, node, out):
   if node is None:
     return
+  if info.ref_info is not None and node.nodeType == element.Node.ELEMENT_NODE:
+    register_references(info.ref_info, node)
   info.push_node_info(node)
   preface_level = get_preface_level(info, node)
   style = info.style() if preface_level is None else None
   inline = style.inline if style is not None else None
   real_out = out
   if inline:
-    out = Out()
-    out.open()
-    info.push(in_inline=real_out)
+    if out.buffer() is None:
+      out = Out()
+      out.open()
+      info.push(in_inline=real_out)
+    else:
+      info.push(in_inline=InlineSpan(out, out.buffer().mark()))
+    if out is not real_out:
+      out.buffer().mark()
   non_inline_out = info.getany('in_inline', otherwise=out)
 
   if node.nodeType == element.Node.ELEMENT_NODE:
@@ -989,7 +1929,7 @@ def convert_node(info, node, out):
       dump_node_exit(info, node, 'paragraph style is None')
 
     elif kind == 'p' and style.name != "Figure":
-      raw_text = get_text(info, node)
+      raw_text = get_text(info, node, out)
       if raw_text != 'Note':
         indent = ''
         if style.name == 'Note' and not info.get('in_table', False, ignore_last=False):
@@ -998,22 +1938,26 @@ def convert_node(info, node, out):
           else:
             raw_text = '.. note:: ' + raw_text
             indent = '  '
-        text = one_sentence_per_line(raw_text, indent)
-        if not inline:
-          text = paragraph_break(text)
+        text = None
+        if not inline and out.deferred_writes is not None and out.path is not None:
+          text = sentence_stage.defer(raw_text, indent)
+        if text is None:
+          text = one_sentence_per_line(raw_text, indent)
+          if not inline:
+            text = paragraph_break(text)
         out.write(text)
 
     elif kind == 'note':
       key = 'footnote{}'.format(len(info.footnotes) + 1)
       non_inline_out.write(' [#{}]_'.format(key))
-      info.footnotes[key] = get_text(info, node)
+      info.footnotes[key] = get_text(info, node, out)
 
     elif kind == 'note-citation':
       pass # This is the footnote number, ignore because we will use our own
 
     elif kind == 'a':
       info.push(ignore_style=True)
-      text = get_text(info, node)
+      text = get_text(info, node, out)
       link = node.attributes[('http://www.w3.org/1999/xlink', 'href')]
       if text == link:
         out.write(link)
@@ -1022,12 +1966,13 @@ def convert_node(info, node, out):
       info.pop()
 
     elif kind == 'image':
-      mime = node.attributes.get(
-        ('urn:oasis:names:tc:opendocument:xmlns:drawing:1.0', 'mime-type'), None)
       href = node.attributes.get(('http://www.w3.org/1999/xlink', 'href'), None)
-      path = Path('images') / Path(href).name
-      if mime == 'image/png' and href:
-        out.writeln('.. image:: {}\n'.format(path))
+      image = images.get(href, None)
+      if image is not None:
+        out.writeln('.. image:: {}'.format(Path('images') / image['name']))
+        if image['size'] is not None:
+          out.writeln('   :width: {}\n   :height: {}'.format(*image['size']))
+        out.writeln('')
 
     elif kind == 'table':
       rows = []
@@ -1061,7 +2006,7 @@ def convert_node(info, node, out):
       reference_format_attr = text_attr('reference-format')
       reference_formats = ("category-and-value", "chapter", "number", "number-all-superior", "page", "text")
       reference_format = node.attributes.get(reference_format_attr, None)
-      value = get_text(info, node)
+      value = get_text(info, node, out)
       if not value.isspace():
         value = value.strip()
       if value:
@@ -1073,13 +2018,14 @@ def convert_node(info, node, out):
               (odf_ref_name.startswith('__RefHeading') and reference_format != 'text'):
             if value.lower().startswith('chapter '):
               value = value[8:]
-            section_info = info.sections[value.strip()]
-            non_inline_out.write(':ref:`{}`'.format(section_info['slug']))
+            non_inline_out.write(':ref:`{}`'.format(info.ref_target('section', value.strip())))
           else:
-            non_inline_out.write(':ref:`{} <{}>`'.format(value, info.references[odf_ref_name]))
+            non_inline_out.write(':ref:`{} <{}>`'.format(
+              value, info.ref_target('reference', odf_ref_name)))
         elif kind == 'sequence-ref' and reference_format == 'category-and-value':
           odf_ref_name = node.attributes[text_attr('ref-name')]
-          non_inline_out.write(':ref:`{} <{}>`'.format(value, info.references[odf_ref_name]))
+          non_inline_out.write(':ref:`{} <{}>`'.format(
+            value, info.ref_target('reference', odf_ref_name)))
         else:
           dump_node_exit(info, node, 'Unexpected reference ' + kind)
 
@@ -1109,46 +2055,973 @@ def convert_node(info, node, out):
     out.write(str(node))
 
   if inline:
-    lines = []
-    for line in out.out.getvalue().split('\n'):
-      if not line.startswith('.. image::'):
-        line = inline_markup(line, inline)
-      lines.append(line)
-    rv = '\n'.join(lines)
+    out.buffer().wrap_lines(inline)
     if kind == 'p':
-      rv = paragraph_break(rv)
-    out.close()
-    real_out.write(rv)
+      out.buffer().paragraph_break()
+    if out is real_out:
+      out.buffer().release()
+    else:
+      real_out.write(out.close())
 
   if inline:
     info.pop() # info.push(in_inline=True)
   info.pop() # info.push_node_info(node)
 
-from odf.office import Body
-body = doc.getElementsByType(Body)[0]
-from odf.text import Section
-section = doc.getElementsByType(Section)[0]
-
-ref_info = Info(doc)
-reference_builder(ref_info, section)
-with (dump_path / 'sections').open('w') as f:
-  for section_id, section_info in ref_info.sections.items():
-    print(section_id, repr(section_info['slug']), repr(section_info['filename']), file=f)
-
-out = Out()
-info = Info(doc, ref_info)
-convert_node(info, section, out)
-out.close()
-out.write_index()
-
-# Dump Style Value Permutations ===============================================
-
-with (dump_path / 'styles_options').open('w') as f:
-  for prop_group_key in sorted(info.all_style_prop_groups):
-    print(prop_group_key, file=f)
-    prop_group = info.all_style_prop_groups[prop_group_key]
-    for prop_key in sorted(prop_group):
-      print('  -', prop_key, file=f)
-      prop = prop_group[prop_key]
-      for prop_value in sorted(prop):
-        print('    -', prop_value, file=f)
+# Profiling ===================================================================
+
+class Profiler:
+  # Counts and times for --report. Node and get_text timing is only done when
+  # enabled, by replacing convert_node and get_text with versions that time
+  # themselves. The other counters are always kept by what they count, and
+  # are started over with take at the start of each conversion.
+  def __init__(self):
+    self.enabled = False
+    self.reset()
+
+  def reset(self):
+    self.node_kinds = {}
+    self.counters = dict(get_text_calls=0, get_text_seconds=0.0,
+      file_writes=0, file_chars_written=0, file_write_seconds=0.0,
+      pages_written=0, pages_unchanged=0)
+    self.stack = []
+
+  # Counters kept as attributes of other objects
+  external_counters = (
+    ('styles_created', Style, 'created'),
+    ('text_buffers_created', TextBuffer, 'created'),
+    ('code_blocks_classified', code_classifier, 'misses'),
+    ('code_classifier_cache_hits', code_classifier, 'hits'),
+  )
+
+  def get_counters(self):
+    counters = dict(self.counters)
+    for name, obj, attr in self.external_counters:
+      counters[name] = getattr(obj, attr)
+    return counters
+
+  def take(self):
+    # Returns what was counted since the last take, for worker processes to
+    # hand over to the parent. Counters kept elsewhere are reset too.
+    state = dict(node_kinds=self.node_kinds, counters=self.get_counters())
+    self.reset()
+    for name, obj, attr in self.external_counters:
+      setattr(obj, attr, 0)
+    return state
+
+  def merge(self, state):
+    for kind, (count, total, own) in state['node_kinds'].items():
+      stats = self.node_kinds.setdefault(kind, [0, 0.0, 0.0])
+      stats[0] += count
+      stats[1] += total
+      stats[2] += own
+    external = {name: (obj, attr) for name, obj, attr in self.external_counters}
+    for name, value in state['counters'].items():
+      if name in external:
+        obj, attr = external[name]
+        setattr(obj, attr, getattr(obj, attr) + value)
+      else:
+        self.counters[name] += value
+
+  def to_json(self):
+    return dict(
+      node_kinds={kind: dict(count=count, seconds=total, own_seconds=own)
+        for kind, (count, total, own) in sorted(self.node_kinds.items())},
+      counters=self.get_counters(),
+    )
+
+
+class TimedFile:
+  # Wraps an output file to count and time the writes to it
+  __slots__ = ('f',)
+
+  def __init__(self, f):
+    self.f = f
+
+  def write(self, string):
+    start = time.perf_counter()
+    self.f.write(string)
+    counters = profiler.counters
+    counters['file_write_seconds'] += time.perf_counter() - start
+    counters['file_writes'] += 1
+    counters['file_chars_written'] += len(string)
+
+  def close(self):
+    self.f.close()
+
+
+plain_convert_node = convert_node
+plain_get_text = get_text
+
+# Recursive calls go through the module globals, so they are timed too.
+# "seconds" for a kind includes the nodes under it, "own_seconds" doesn't.
+def timed_convert_node(info, node, out):
+  if node is None:
+    return
+  kind = node.qname[1] if node.nodeType == element.Node.ELEMENT_NODE else '#text'
+  profiler.stack.append(0.0)
+  start = time.perf_counter()
+  try:
+    plain_convert_node(info, node, out)
+  finally:
+    seconds = time.perf_counter() - start
+    children = profiler.stack.pop()
+    if profiler.stack:
+      profiler.stack[-1] += seconds
+    stats = profiler.node_kinds.setdefault(kind, [0, 0.0, 0.0])
+    stats[0] += 1
+    stats[1] += seconds
+    stats[2] += seconds - children
+
+
+def timed_get_text(info, node, out=None):
+  start = time.perf_counter()
+  try:
+    return plain_get_text(info, node, out)
+  finally:
+    profiler.counters['get_text_calls'] += 1
+    profiler.counters['get_text_seconds'] += time.perf_counter() - start
+
+
+def set_profiling(enabled):
+  global convert_node, get_text
+  profiler.enabled = enabled
+  convert_node = timed_convert_node if enabled else plain_convert_node
+  get_text = timed_get_text if enabled else plain_get_text
+
+
+def get_report(info, out):
+  report = timings.to_json()
+  report.update(profiler.to_json())
+  report['counters'].update(
+    style_cache_hits=info.styles.hits,
+    style_cache_misses=info.styles.misses,
+    sentence_cache_hits=sentence_cache.hits,
+    sentence_cache_misses=sentence_cache.misses,
+    sentences_without_ends=sentence_cache.skipped,
+    sentence_splitting_seconds=sentence_cache.spent,
+    sentence_splitting_seconds_saved=sentence_cache.saved,
+    pages=len(out.pages),
+  )
+  report['options'] = {k: sorted(v) if isinstance(v, set) else v
+    for k, v in vars(args).items()}
+  return report
+
+
+profiler = Profiler()
+
+
+# Parallel Conversion =========================================================
+
+def get_chapter_header(info, node, in_preface):
+  # If node starts with a chapter header, return it. Chapter headers are
+  # usually wrapped in lists, so look through the first child of those.
+  while node.nodeType == element.Node.ELEMENT_NODE and \
+      node.qname[1] in ('list', 'list-item') and node.childNodes:
+    node = node.childNodes[0]
+  if node.nodeType != element.Node.ELEMENT_NODE:
+    return None
+  kind = node.qname[1]
+  if kind == 'h':
+    if node.attributes.get(outline_level, None) != '1':
+      return None
+  elif kind != 'p' or not in_preface or \
+      info.styles.get_preheader_level(get_style_name(node)) != 1:
+    return None
+  for child in node.childNodes:
+    # See the Figure 1-1 hack in handle_header, these are written to the
+    # previous chapter.
+    if child.nodeType == element.Node.ELEMENT_NODE and child.qname[1] == 'frame':
+      return None
+  return node
+
+
+def is_header(node):
+  return node.nodeType == element.Node.ELEMENT_NODE and node.qname[1] == 'h'
+
+
+def split_chapters(info, section):
+  # Split the top level nodes of the section in front of chapter headers.
+  # Returns a list of (nodes, in_preface) with what in_preface will be when
+  # conversion reaches the first node.
+  chunks = [([], True)]
+  in_preface = True
+  for node in section.childNodes:
+    if chunks[-1][0] and get_chapter_header(info, node, in_preface) is not None:
+      chunks.append(([], in_preface))
+    chunks[-1][0].append(node)
+    if in_preface and find_node_where(node, is_header) is not None:
+      in_preface = False
+  return chunks
+
+
+# Set before forking the worker processes
+parallel_chunks = None
+
+def convert_chunk(index):
+  # Converts one chunk from split_chapters, usually in a worker process. The
+  # document and reference tables are inherited from the parent by forking.
+  try:
+    nodes, in_preface = parallel_chunks[index]
+    info = Info(doc, ref_info)
+    # Chunks converted in this process share the style resolver with the
+    # parent, so hand back only what this chunk counted for merge_chunk_result
+    # to add.
+    hits, misses = info.styles.hits, info.styles.misses
+    info.in_preface = in_preface
+    info.used_refs = []
+    out = Out()
+    if sentence_stage.jobs:
+      # Chapter workers can't have workers of their own, so the parent splits
+      # the sentences and writes the pages with write_chunk_pages.
+      out.deferred_writes = []
+    info.push_node_info(section)
+    convert_child_nodes(info, section, out, nodes)
+    info.pop()
+    if index + 1 < len(parallel_chunks):
+      # The next chapter header would have written these
+      write_footnotes(info, out)
+    out.close()
+    chunk_hits = info.styles.hits - hits
+    chunk_misses = info.styles.misses - misses
+    info.styles.hits, info.styles.misses = hits, misses
+    return dict(pages=out.pages, style_options=info.all_style_prop_groups,
+      hits=chunk_hits, misses=chunk_misses, refs=info.used_refs,
+      sentences=sentence_cache.take(), split_used=sentence_stage.take_used(),
+      deferred_writes=out.deferred_writes, sentence_texts=sentence_stage.take_texts(),
+      profile=profiler.take())
+  except ConversionError as e:
+    raise ConversionError('Converting chapter chunk {} failed: {}'.format(index, e))
+
+
+def reset_worker():
+  # Workers inherit the parent's counts, so start over
+  ref_info.styles.hits = 0
+  ref_info.styles.misses = 0
+  sentence_cache.take()
+  sentence_stage.take_used()
+  sentence_stage.take_texts()
+  profiler.take()
+
+
+def convert_chunks(indices, jobs):
+  if jobs > 1 and len(indices) > 1:
+    context = multiprocessing.get_context('fork')
+    with context.Pool(min(jobs, len(indices)), initializer=reset_worker) as pool:
+      return pool.map(convert_chunk, indices, chunksize=1)
+  return [convert_chunk(index) for index in indices]
+
+
+def write_chunk_pages(result):
+  # Writes the pages convert_chunk kept back for --sentence-jobs
+  if result.get('deferred_writes', None) is not None:
+    out = Out()
+    out.deferred_writes = result['deferred_writes']
+    out.write_deferred(sentence_stage.split(result['sentence_texts']))
+
+
+def merge_chunk_result(info, out, result):
+  out.pages.extend(result['pages'])
+  for k, v in result['style_options'].items():
+    group = info.all_style_prop_groups.setdefault(k, {})
+    for ki, vi in v.items():
+      group.setdefault(ki, set()).update(vi)
+  info.styles.hits += result['hits']
+  info.styles.misses += result['misses']
+  if 'sentences' in result:
+    sentence_cache.merge(result['sentences'])
+    sentence_stage.used += result['split_used']
+    profiler.merge(result['profile'])
+
+
+def convert_in_parallel(info, section, out, jobs):
+  global parallel_chunks
+  parallel_chunks = split_chapters(info, section)
+  for result in convert_chunks(list(range(len(parallel_chunks))), jobs):
+    write_chunk_pages(result)
+    merge_chunk_result(info, out, result)
+  sentence_stage.finish()
+
+
+# Sentence Splitting Stage ====================================================
+
+# With --sentence-jobs, paragraphs written straight to a page that need
+# splitting into sentences and aren't in the sentence cache are written as a
+# placeholder instead, and Out keeps what's written to pages until the end.
+# The texts are sent to worker processes in batches while the conversion goes
+# on. At the end the results are collected and the pages are written with
+# the placeholders replaced. Chapter workers can't have workers of their own,
+# so they hand their texts to the parent, which splits what's left of them
+# all at once.
+
+sentence_placeholder_re = re.compile(r'\x00(\d+)split')
+
+
+def split_sentence_batch(batch):
+  results = []
+  for text, indent in batch:
+    start = time.perf_counter()
+    result = segment_sentences(text, indent)
+    results.append((result, time.perf_counter() - start))
+  return results
+
+
+class SentenceStage:
+  batch_size = 32
+
+  def __init__(self, jobs):
+    self.jobs = jobs
+    self.pool = None
+    self.texts = [] # ((text, indent), mask) of each placeholder
+    self.unsent = {} # Texts to send to the pool, in order
+    self.sent = set()
+    self.batches = [] # (batch, AsyncResult)
+    self.done = {}
+    self.fresh = set() # Texts in done that no placeholder was counted for yet
+    self.scheduled = 0
+    self.used = 0
+
+  def get_pool(self):
+    if self.pool is None:
+      context = multiprocessing.get_context('fork')
+      # Each worker loads its own tokenizer while the conversion goes on
+      self.pool = context.Pool(self.jobs, initializer=get_sentence_tokenizer)
+    return self.pool
+
+  def defer(self, text, indent):
+    # Returns a placeholder for text split into sentences and followed by a
+    # paragraph break, or None if that should just be done now.
+    if not needs_splitting(text):
+      return None
+    text, mask = mask_deferred_refs(text)
+    if sentence_cache.contains(text, indent):
+      return None
+    item = (text, indent)
+    if item not in self.sent and item not in self.done:
+      self.unsent[item] = None
+      if len(self.unsent) >= self.batch_size and \
+          not multiprocessing.current_process().daemon:
+        self.send()
+    self.texts.append((item, mask))
+    self.used += 1
+    return '\x00{}split'.format(len(self.texts) - 1)
+
+  def send(self):
+    batch = list(self.unsent)
+    self.unsent = {}
+    self.sent.update(batch)
+    self.batches.append((batch, self.get_pool().apply_async(split_sentence_batch, (batch,))))
+
+  def add_results(self, batch, results):
+    for item, (result, seconds) in zip(batch, results):
+      sentence_cache.add(item[0], item[1], result, seconds)
+      self.done[item] = result
+    self.fresh.update(batch)
+    self.scheduled += len(batch)
+
+  def take_texts(self):
+    # Returns the texts the placeholders so far are for, in their order
+    texts = self.texts
+    self.texts = []
+    self.unsent = {}
+    return texts
+
+  def take_used(self):
+    used = self.used
+    self.used = 0
+    return used
+
+  def split(self, texts):
+    # Returns each of texts from take_texts ready to replace its placeholder
+    start = time.perf_counter()
+    for batch, pending in self.batches:
+      self.add_results(batch, pending.get())
+    self.batches = []
+    self.sent = set()
+    items = dict.fromkeys(item for item, mask in texts)
+    todo = [item for item in items if item not in self.done]
+    batches = [todo[i:i + self.batch_size] for i in range(0, len(todo), self.batch_size)]
+    if batches:
+      for batch, results in zip(batches, self.get_pool().imap(split_sentence_batch, batches)):
+        self.add_results(batch, results)
+    timings.record('waiting for sentence workers', time.perf_counter() - start)
+    results = []
+    for item, mask in texts:
+      if item in self.fresh:
+        self.fresh.discard(item)
+      elif sentence_cache.get(*item) is None:
+        # Split before, count it like one_sentence_per_line would
+        sentence_cache.add(item[0], item[1], self.done[item], 0.0)
+      results.append(paragraph_break(unmask_deferred_refs(self.done[item], mask)))
+    return results
+
+  def finish(self):
+    if self.pool is not None:
+      self.pool.terminate()
+      self.pool.join()
+      self.pool = None
+
+  def __repr__(self):
+    return '{} paragraphs split in worker processes, {} placeholders'.format(
+      self.scheduled, self.used)
+
+
+# Replaced for each conversion
+sentence_stage = SentenceStage(0)
+
+
+# Incremental Conversion ======================================================
+
+class HashWriter:
+  # File-like object for toXml that hashes what is written
+  def __init__(self, hasher):
+    self.hasher = hasher
+
+  def write(self, string):
+    self.hasher.update(string.encode('utf-8'))
+
+
+def get_converter_hash():
+  # Covers the converter and the options that change the output of every
+  # chapter. The punkt version also covers the version of NLTK.
+  hasher = hashlib.sha256()
+  for name in ('convert.py', 'monospace.py', 'odt_reader.py', 'code_language.py'):
+    hasher.update((Path(__file__).resolve().parent / name).read_bytes())
+  hasher.update(repr((get_punkt_version(), list(args.code_priority))).encode('utf-8'))
+  return hasher.hexdigest()
+
+
+def get_chunk_hash(info, index, converter_hash):
+  # Covers everything the output of the chunk depends on except the targets
+  # of its references, which are checked separately.
+  nodes, in_preface = parallel_chunks[index]
+  hasher = hashlib.sha256()
+  hasher.update(repr((converter_hash, in_preface, index + 1 < len(parallel_chunks))).encode('utf-8'))
+  writer = HashWriter(hasher)
+  style_names = set()
+  labels = []
+  for node in nodes:
+    node.toXml(1, writer)
+    stack = [node]
+    while stack:
+      node = stack.pop()
+      if node.nodeType != element.Node.ELEMENT_NODE:
+        continue
+      style_names.add(get_style_name(node))
+      kind = node.qname[1]
+      section_id = getattr(node, 'opendds_section_id', None)
+      if section_id is not None:
+        labels.append((section_id, info.sections[section_id]))
+      elif kind == 'bookmark-start':
+        name = get_attr(node, text_attr('name'))
+        labels.append((name, info.references.get(name, None)))
+      elif kind == 'sequence':
+        name = get_attr(node, text_attr('ref-name'))
+        labels.append((name, info.references.get(name, None)))
+      elif kind == 'image':
+        name = get_attr(node, ('http://www.w3.org/1999/xlink', 'href'))
+        labels.append((name, images.get(name, None)))
+      stack.extend(reversed(node.childNodes))
+  hasher.update(repr(labels).encode('utf-8'))
+  style_names.discard(None)
+  for name in sorted(style_names):
+    props = info.styles.get_props(name)
+    hasher.update(repr((
+      name,
+      sorted((k, sorted(v.items())) for k, v in props.items()),
+      info.styles.get_ancestry(name),
+      info.styles.list_styles.get(name, None),
+    )).encode('utf-8'))
+  return hasher.hexdigest()
+
+
+def get_chunk_name(info, index):
+  nodes, in_preface = parallel_chunks[index]
+  header = get_chapter_header(info, nodes[0], in_preface)
+  return str(header).strip() if header is not None else 'Start of Document'
+
+
+class ChapterCache:
+  # Converted chapters from earlier runs, keyed by the hash of the chunk
+  # they came from. Stores the .rst files of each chunk, the references
+  # they used and the rest of what convert_chunk returned.
+  def __init__(self, path):
+    self.path = path
+    self.manifest_path = path / 'manifest.json'
+    self.entries = {}
+    if self.manifest_path.is_file():
+      self.entries = json.loads(self.manifest_path.read_text())
+
+  def rst_path(self, chunk_hash):
+    return self.path / 'rst' / chunk_hash
+
+  def get(self, chunk_hash):
+    entry = self.entries.get(chunk_hash, None)
+    if entry is not None and not self.rst_path(chunk_hash).is_dir():
+      return None
+    return entry
+
+  def store(self, chunk_hash, result):
+    rst_path = self.rst_path(chunk_hash)
+    if rst_path.is_dir():
+      shutil.rmtree(rst_path)
+    rst_path.mkdir(parents=True)
+    for name, filename in result['pages']:
+      shutil.copyfile(export_path / filename, rst_path / filename)
+    self.entries[chunk_hash] = dict(
+      pages=result['pages'],
+      refs=result['refs'],
+      style_options=[[k, [[ki, sorted(vi)] for ki, vi in v.items()]]
+        for k, v in result['style_options'].items()],
+    )
+
+  def restore(self, chunk_hash):
+    entry = self.entries[chunk_hash]
+    for name, filename in entry['pages']:
+      if update_file(export_path / filename, (self.rst_path(chunk_hash) / filename).read_bytes()):
+        profiler.counters['pages_written'] += 1
+      else:
+        profiler.counters['pages_unchanged'] += 1
+    return dict(
+      pages=[tuple(page) for page in entry['pages']],
+      style_options={tuple(k): {tuple(ki): set(vi) for ki, vi in v}
+        for k, v in entry['style_options']},
+      hits=0, misses=0, refs=entry['refs'])
+
+  def save(self, keep):
+    # Only keep what this run used
+    for chunk_hash in list(self.entries):
+      if chunk_hash not in keep:
+        del self.entries[chunk_hash]
+    rst_path = self.path / 'rst'
+    if rst_path.is_dir():
+      for path in rst_path.iterdir():
+        if path.name not in keep:
+          shutil.rmtree(path)
+    self.path.mkdir(parents=True, exist_ok=True)
+    self.manifest_path.write_text(json.dumps(self.entries, indent=1))
+
+
+def get_changed_refs(info, refs):
+  changed = []
+  for kind, key, target in refs:
+    if kind == 'section':
+      current = info.sections.get(key, {}).get('slug', None)
+    else:
+      current = info.references.get(key, None)
+    if current != target:
+      changed.append(key)
+  return list(dict.fromkeys(changed))
+
+
+def convert_incrementally(info, section, out, jobs, cache_path):
+  global parallel_chunks
+  parallel_chunks = split_chapters(info, section)
+  cache = ChapterCache(cache_path)
+  converter_hash = get_converter_hash()
+  hashes = [get_chunk_hash(info, i, converter_hash) for i in range(len(parallel_chunks))]
+
+  rebuild = []
+  for index, chunk_hash in enumerate(hashes):
+    name = get_chunk_name(info, index)
+    entry = cache.get(chunk_hash)
+    if entry is None:
+      print('Rebuilding {}: new or changed content'.format(repr(name)))
+      rebuild.append(index)
+      continue
+    changed = get_changed_refs(info, entry['refs'])
+    if changed:
+      print('Rebuilding {}: targets of references changed: {}'.format(
+        repr(name), ', '.join(changed)))
+      rebuild.append(index)
+    else:
+      print('Reusing {}'.format(repr(name)))
+
+  results = dict(zip(rebuild, convert_chunks(rebuild, jobs)))
+  for index, chunk_hash in enumerate(hashes):
+    if index in results:
+      write_chunk_pages(results[index])
+      cache.store(chunk_hash, results[index])
+    else:
+      results[index] = cache.restore(chunk_hash)
+    merge_chunk_result(info, out, results[index])
+  cache.save(set(hashes))
+  sentence_stage.finish()
+  print('Rebuilt {} of {} chapters'.format(len(rebuild), len(hashes)))
+
+
+# Watch Mode ==================================================================
+
+def wait_for_change(path, stamp, digest, interval):
+  # Polls path every interval seconds until what's in it is different from
+  # digest. It's only hashed again when the modification time or size
+  # changes. Returns the new stamp and hash.
+  while True:
+    time.sleep(interval)
+    new_stamp = get_file_stamp(path)
+    if new_stamp is None or new_stamp == stamp:
+      continue
+    stamp = new_stamp
+    try:
+      new_digest = get_file_hash(path)
+    except FileNotFoundError:
+      continue
+    if new_digest != digest:
+      return stamp, new_digest
+    print('{} was saved without changes'.format(path))
+
+
+def dump_sections(ref_info):
+  if 'sections' not in args.dump:
+    return
+  with open_dump('sections') as f:
+    for section_id, section_info in ref_info.sections.items():
+      print(section_id, repr(section_info['slug']), repr(section_info['filename']), file=f)
+
+
+# Converter ===================================================================
+
+class Converter:
+  # Converts an ODT to RST files in output_path. The options are the same as
+  # the command line ones, named like argparse names them. What doesn't
+  # depend on the document, like punkt models and the code classifier cache,
+  # stays loaded for later conversions in the same process. The state of the
+  # conversion in progress is kept in module globals, where the functions
+  # above and forked workers get it from, so only one conversion can run at a
+  # time in a process.
+  #
+  # share_styles reuses the style resolver of an earlier conversion in the
+  # process if the style tables of the document are exactly the same.
+  # chapter_cache_path is where --incremental keeps chapters, by default
+  # --cache-dir.
+  def __init__(self, odt_path, output_path='devguide', dump_path='dump',
+      share_styles=False, chapter_cache_path=None, **options):
+    self.odt_path = Path(odt_path)
+    self.output_path = Path(output_path)
+    self.dump_path = Path(dump_path)
+    self.share_styles = share_styles
+    self.chapter_cache_path = chapter_cache_path
+    self.options = get_arg_parser().parse_args([])
+    for name, value in options.items():
+      if not hasattr(self.options, name):
+        raise TypeError('Unknown option for Converter: ' + name)
+      setattr(self.options, name, value)
+    check_options(self.options)
+    self.pages = None
+    self.timings = None
+    self.report = None
+
+  def get_converter_hash(self):
+    # What the output depends on besides the document, for callers that keep
+    # track of what they converted themselves
+    global args
+    args = self.options
+    return get_converter_hash()
+
+  def convert(self, phase_timings=None):
+    # Returns the (name, filename) of each page written. phase_timings is for
+    # the command line to pass the timings of the imports and arguments.
+    global args, timings, odt_path, doc, dump_path, export_path, images_path, \
+      images, sentence_cache, sentence_stage, section, ref_info
+    args = self.options
+    timings = phase_timings or Timings(time.perf_counter(), time.process_time())
+    self.timings = timings
+    profiler.take() # Start over the counts from the last conversion
+    code_classifier.set_priority(args.code_priority)
+    sentence_cache = get_sentence_cache()
+    sentence_stage = SentenceStage(args.sentence_jobs)
+
+    odt_path = self.odt_path
+    if args.reader == 'stream':
+      doc = odt_reader.load(str(odt_path))
+    else:
+      doc = load(str(odt_path))
+    timings.mark('loading document')
+
+    dump_path = self.dump_path
+    if args.dump:
+      dump_path.mkdir(parents=True, exist_ok=True)
+    dump_document(doc)
+    timings.mark('dumping document')
+
+    export_path = self.output_path
+    images_path = export_path / 'images'
+    images_path.mkdir(parents=True, exist_ok=True)
+    images = get_images(doc)
+    extract_images(doc, images)
+    timings.mark('extracting images')
+
+    section = doc.getElementsByType(Section)[0]
+    ref_info = Info(doc, styles=get_shared_style_resolver(doc) if self.share_styles else None)
+    if not args.single_pass:
+      reference_builder(ref_info, section)
+      dump_sections(ref_info)
+      timings.mark('reference pass')
+
+    set_profiling(bool(args.report))
+    if args.profile:
+      import cProfile
+      conversion_profile = cProfile.Profile()
+      conversion_profile.enable()
+
+    out = Out()
+    info = Info(doc, ref_info)
+    if args.single_pass:
+      info.defer_refs(ref_info)
+      out.held_pages = {}
+    if args.incremental:
+      convert_incrementally(info, section, out, args.jobs,
+        Path(self.chapter_cache_path or args.cache_dir))
+    elif args.jobs > 1:
+      convert_in_parallel(info, section, out, args.jobs)
+    else:
+      if sentence_stage.jobs:
+        out.deferred_writes = []
+      convert_node(info, section, out)
+    out.close()
+    if out.deferred_writes is not None:
+      out.write_deferred(sentence_stage.split(sentence_stage.take_texts()))
+      sentence_stage.finish()
+    if args.single_pass:
+      patch_deferred_refs(info, out)
+      dump_sections(ref_info)
+    timings.mark('conversion')
+    if args.profile:
+      conversion_profile.disable()
+      conversion_profile.dump_stats(args.profile)
+    out.write_index()
+    remove_stale_pages(export_path, out.pages)
+    counters = profiler.counters
+    print('Pages: {} written, {} unchanged'.format(
+      counters['pages_written'], counters['pages_unchanged']))
+    print('Style cache: {} hits, {} misses'.format(info.styles.hits, info.styles.misses))
+    sentence_cache.save()
+    print('Sentence cache:', sentence_cache)
+    if args.sentence_jobs:
+      print('Sentence stage:', sentence_stage)
+
+    # Dump Style Value Permutations
+    if 'styles' in args.dump:
+      with open_dump('styles_options') as f:
+        for prop_group_key in sorted(info.all_style_prop_groups):
+          print(prop_group_key, file=f)
+          prop_group = info.all_style_prop_groups[prop_group_key]
+          for prop_key in sorted(prop_group):
+            print('  -', prop_key, file=f)
+            prop = prop_group[prop_key]
+            for prop_value in sorted(prop):
+              print('    -', prop_value, file=f)
+    timings.mark('writing index and dumps')
+
+    if args.sync_to:
+      sync_to = Path(args.sync_to)
+      sync_directory(export_path, sync_to, get_sync_manifest_path(sync_to))
+      timings.mark('syncing output')
+
+    if args.timings:
+      timings.print()
+    self.report = get_report(info, out)
+    if args.report:
+      Path(args.report).write_text(json.dumps(self.report, indent=2) + '\n')
+    self.pages = out.pages
+    return out.pages
+
+  def watch(self, interval=1.0, phase_timings=None):
+    # Converts, then converts again each time the ODT changes until
+    # interrupted. This should be used with incremental, which --watch
+    # implies. If a conversion fails, it's printed and the next change is
+    # waited for.
+    stamp = get_file_stamp(self.odt_path)
+    digest = get_file_hash(self.odt_path)
+    while True:
+      start = time.perf_counter()
+      try:
+        self.convert(phase_timings)
+      except Exception as e:
+        if not isinstance(e, ConversionError):
+          import traceback
+          traceback.print_exc()
+        print('Converting {} failed: {}'.format(self.odt_path, e), file=sys.stderr)
+      else:
+        print('Converted {} in {:.3f}s'.format(self.odt_path, time.perf_counter() - start))
+      phase_timings = None
+      print('Watching {} for changes'.format(self.odt_path))
+      sys.stdout.flush()
+      stamp, digest = wait_for_change(self.odt_path, stamp, digest, interval)
+
+
+# Batch Conversion ============================================================
+
+def get_batch_converters(options):
+  # A Converter for each --batch ODT OUTPUT, raising ValueError for anything
+  # wrong with the options. The dumps of each document go next to its output
+  # and so do the reports, with the one for the whole batch going to --report.
+  if options.profile:
+    raise ValueError('--profile can\'t be used with --batch')
+  if options.watch:
+    raise ValueError('--watch can\'t be used with --batch')
+  if options.batch_jobs > 1 and (options.jobs > 1 or options.sentence_jobs):
+    raise ValueError('--batch-jobs workers can\'t start workers of their own, '
+      'so --jobs and --sentence-jobs can\'t be used with it')
+  outputs = [Path(output).resolve() for odt, output in options.batch]
+  if len(set(outputs)) != len(outputs):
+    raise ValueError('Each document in --batch needs its own output directory')
+  converters = []
+  for (odt, output), resolved in zip(options.batch, outputs):
+    document_options = dict(vars(options), batch=None, batch_jobs=1)
+    if options.report:
+      document_options['report'] = output + '-report.json'
+    chapter_cache_path = Path(options.cache_dir) / 'documents' / \
+      hashlib.sha1(str(resolved).encode('utf-8')).hexdigest()[:16]
+    converters.append(Converter(odt, output, output + '-dump', share_styles=True,
+      chapter_cache_path=chapter_cache_path, **document_options))
+  return converters
+
+
+batch_converters = None
+
+def convert_document(index):
+  # Converts one document of the batch, maybe in a worker process. Failing
+  # is reported in the result instead of stopping the batch.
+  converter = batch_converters[index]
+  print('Converting {} to {}'.format(converter.odt_path, converter.output_path))
+  result = dict(odt=str(converter.odt_path), output=str(converter.output_path),
+    ok=True, error=None, pages=None, timings=None, report=None)
+  try:
+    converter.convert()
+  except Exception as e:
+    if not isinstance(e, ConversionError):
+      import traceback
+      traceback.print_exc()
+    print('Converting {} failed: {}'.format(converter.odt_path, e), file=sys.stderr)
+    result.update(ok=False, error=str(e) or type(e).__name__)
+  else:
+    result.update(pages=len(converter.pages), report=converter.report)
+  if converter.timings is not None:
+    result['timings'] = converter.timings.to_json()
+  sys.stdout.flush()
+  return result
+
+
+def sync_output(options, output_path='devguide'):
+  # --sync-only. An output directory that isn't there would look like every
+  # file synced before was removed from it.
+  global args
+  args = options
+  output_path = Path(output_path)
+  if not output_path.is_dir():
+    raise ValueError('There is no output in {} to sync'.format(output_path))
+  sync_to = Path(args.sync_to)
+  sync_directory(output_path, sync_to, get_sync_manifest_path(sync_to))
+
+
+def warm_up(options):
+  # Load the punkt model before forking so every worker starts with it
+  global args, timings
+  args = options
+  timings = Timings(time.perf_counter(), time.process_time())
+  try:
+    get_sentence_tokenizer()
+    get_punkt_version()
+  except ConversionError:
+    pass # Every document will fail with it
+
+
+def print_batch_results(results, seconds):
+  phases = list(dict.fromkeys(phase['name']
+    for result in results if result['timings'] for phase in result['timings']['phases']))
+  print('Batch:')
+  print('  {:<24} {:>6} {:>6}'.format('document', 'status', 'pages') +
+    ''.join(' {:>10}'.format(name.split()[0]) for name in phases) + ' {:>10}'.format('total'))
+  totals = dict.fromkeys(phases, 0.0)
+  for result in results:
+    times = {}
+    if result['timings']:
+      times = {phase['name']: phase['wall'] for phase in result['timings']['phases']}
+    for name, wall in times.items():
+      totals[name] += wall
+    print('  {:<24.24} {:>6} {:>6}'.format(Path(result['odt']).name,
+      'ok' if result['ok'] else 'FAILED', '-' if result['pages'] is None else result['pages']) +
+      ''.join(' {:>9.3f}s'.format(times[name]) if name in times else ' {:>10}'.format('-')
+        for name in phases) + ' {:>9.3f}s'.format(sum(times.values())))
+  print('  {:<24} {:>6} {:>6}'.format('total',
+    sum(result['ok'] for result in results), sum(result['pages'] or 0 for result in results)) +
+    ''.join(' {:>9.3f}s'.format(totals[name]) for name in phases) +
+    ' {:>9.3f}s'.format(sum(totals.values())))
+  failed = [result for result in results if not result['ok']]
+  print('Converted {} of {} documents in {:.3f}s'.format(
+    len(results) - len(failed), len(results), seconds))
+  for result in failed:
+    print('  {} failed: {}'.format(result['odt'], result['error']))
+
+
+def convert_batch(options):
+  # Converts the --batch documents and returns the result of each one from
+  # convert_document
+  global batch_converters
+  batch_converters = get_batch_converters(options)
+  start = time.perf_counter()
+  indices = list(range(len(batch_converters)))
+  jobs = min(options.batch_jobs, len(indices))
+  if jobs > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+    print('Warning: --batch-jobs needs fork, converting serially', file=sys.stderr)
+    jobs = 1
+  if jobs > 1:
+    warm_up(batch_converters[0].options)
+    context = multiprocessing.get_context('fork')
+    with context.Pool(jobs) as pool:
+      results = list(pool.imap(convert_document, indices, chunksize=1))
+  else:
+    results = [convert_document(index) for index in indices]
+  seconds = time.perf_counter() - start
+  print_batch_results(results, seconds)
+  if options.report:
+    report = dict(seconds=seconds, documents=results)
+    Path(options.report).write_text(json.dumps(report, indent=2) + '\n')
+  return results
+
+
+def main():
+  timings.mark('imports')
+  arg_parser = get_arg_parser()
+  options = arg_parser.parse_args()
+  if options.sync_only:
+    if not options.sync_to:
+      arg_parser.error('--sync-only needs --sync-to')
+    if options.batch or options.watch:
+      arg_parser.error('--sync-only can\'t be used with --batch or --watch')
+    try:
+      sync_output(options)
+    except ValueError as e:
+      arg_parser.error(str(e))
+    return
+  if options.batch:
+    try:
+      results = convert_batch(options)
+    except ValueError as e:
+      arg_parser.error(str(e))
+    if not all(result['ok'] for result in results):
+      sys.exit(1)
+    return
+  if 'OPENDDS_DEVGUIDE_ODT' not in os.environ:
+    arg_parser.error('OPENDDS_DEVGUIDE_ODT must be set to the path of the DevGuide ODT')
+  try:
+    # Changes to a document usually leave the styles as they were
+    converter = Converter(os.environ['OPENDDS_DEVGUIDE_ODT'],
+      share_styles=options.watch, **vars(options))
+  except ValueError as e:
+    arg_parser.error(str(e))
+  timings.mark('arguments')
+  if options.watch:
+    try:
+      converter.watch(options.watch_interval, timings)
+    except KeyboardInterrupt:
+      print()
+    return
+  try:
+    converter.convert(timings)
+  except RuntimeError as e:
+    sys.exit(str(e))
+
+
+if __name__ == '__main__':
+  main()
@@ -1,11 +1,9 @@
 set -e
 
-rm -fr dump devguide build
 python3 convert.py
-# Replace multiple empty lines with just one
-find devguide -type f -name '*.rst' -exec sed -i '/^$/N;/^\n$/D' {} \;
 sphinx-build -b html . ./build
+# Only update DDS_ROOT with output that built
 if [ ! -z "$DDS_ROOT" ]
 then
-  cp -r devguide/* $DDS_ROOT/docs/devguide
+  python3 convert.py --sync-only --sync-to $DDS_ROOT/docs/devguide
 fi
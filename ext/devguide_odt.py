@@ -0,0 +1,76 @@
+from pathlib import Path
+
+from sphinx.errors import ExtensionError
+from sphinx.util import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Converts the DevGuide ODT as part of the Sphinx build, so running
+# convert.py first isn't needed:
+#
+#   sphinx-build -D devguide_odt=DevGuide.odt -j auto . build
+#
+# The conversion runs once before Sphinx looks for changed documents. It's
+# incremental and only replaces the chapter pages whose contents changed, so
+# Sphinx only reads those chapters again and the rest come from its saved
+# environment. The environment also keeps the hash of the ODT, so if the ODT
+# and the options are the same as the last build it isn't converted at all.
+# That includes the converter and what it uses that the options don't name,
+# like the punkt model and the default code priority.
+# The chapters are read by Sphinx like any other document, so nothing here
+# gets in the way of reading them in parallel.
+def convert_odt(app):
+    if not app.config.devguide_odt:
+        return
+    import convert
+
+    odt_path = Path(app.confdir) / app.config.devguide_odt
+    output_path = Path(app.srcdir) / app.config.devguide_output
+    options = dict(
+        incremental=True,
+        cache_dir=str(Path(app.confdir) / '.convert_cache'),
+    )
+    options.update(app.config.devguide_converter_options)
+    try:
+        converter = convert.Converter(odt_path, output_path,
+            Path(app.confdir) / 'dump', **options)
+        state = (
+            str(odt_path),
+            str(output_path),
+            convert.get_file_hash(odt_path),
+            sorted(options.items()),
+            converter.get_converter_hash(),
+        )
+    except (TypeError, ValueError, RuntimeError) as e:
+        raise ExtensionError('Converting {} failed: {}'.format(odt_path, e))
+
+    env = app.env
+    last_state = getattr(env, 'devguide_odt_state', None)
+    pages = getattr(env, 'devguide_odt_pages', [])
+    if last_state == state and all((output_path / filename).is_file() for filename in pages):
+        logger.info('devguide_odt: {} is unchanged, not converting it'.format(odt_path))
+        return
+
+    logger.info('devguide_odt: converting {} to {}'.format(odt_path, output_path))
+    try:
+        converter.convert()
+    except (TypeError, ValueError, RuntimeError) as e:
+        raise ExtensionError('Converting {} failed: {}'.format(odt_path, e))
+    env.devguide_odt_state = state
+    env.devguide_odt_pages = [filename for name, filename in converter.pages] + ['index.rst']
+
+
+def setup(app):
+    # These only decide what gets converted, what actually changed is decided
+    # by the pages, so changing them doesn't need everything to be read again.
+    app.add_config_value('devguide_odt', None, '')
+    app.add_config_value('devguide_output', 'devguide', '')
+    app.add_config_value('devguide_converter_options', {}, '')
+
+    app.connect('builder-inited', convert_odt)
+
+    return {
+        'parallel_read_safe': True,
+        'parallel_write_safe': True,
+    }
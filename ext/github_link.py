@@ -44,3 +44,8 @@ def setup(app):
     app.add_role('ghfile', ghfile)
     app.add_role('ghissue', ghissue)
     app.add_role('ghpr', ghpr)
+
+    return {
+        'parallel_read_safe': True,
+        'parallel_write_safe': True,
+    }
@@ -0,0 +1,189 @@
+import hashlib
+import inspect
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+import pygments
+import sphinx
+from sphinx.highlighting import lexer_classes
+from sphinx.util import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Caches the output of Pygments for code blocks between builds, so code that
+# hasn't changed doesn't have to be highlighted again. Output is keyed by the
+# hash of the code and everything else that goes into highlighting it: the
+# lexer and its options, the formatter, and the versions of Pygments, Sphinx
+# and any lexer added with add_lexer, like mpc_lexer. At the end of the build
+# the least recently used output is evicted to keep the cache under
+# highlight_cache_size MB, and how much time it saved is logged.
+#
+# Sphinx can write documents in worker processes without handing anything
+# back, so output is written to the database as soon as it's made. Workers
+# also keep their counts there under the id of the build.
+class HighlightCache:
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.build = '{}-{}'.format(os.getpid(), time.time())
+        self.db = None
+        self.pid = None
+        self.lexer_versions = {}
+        self.reset()
+
+    def reset(self):
+        self.hits = 0
+        self.misses = 0
+        self.saved = 0.0
+        self.spent = 0.0
+
+    def connect(self):
+        # Forked workers can't use a connection the parent opened and start
+        # with the parent's counts
+        if self.db is None or self.pid != os.getpid():
+            if self.db is not None:
+                self.reset()
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.db = sqlite3.connect(str(self.path), timeout=60, isolation_level=None)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=OFF') # Losing some of it is fine
+            self.db.execute('CREATE TABLE IF NOT EXISTS highlighted '
+                '(key BLOB PRIMARY KEY, output TEXT, seconds REAL, used INTEGER)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS counts '
+                '(build TEXT, pid INTEGER, hits INTEGER, misses INTEGER, '
+                'saved REAL, spent REAL, PRIMARY KEY (build, pid))')
+            self.pid = os.getpid()
+        return self.db
+
+    def get_lexer_version(self, lang):
+        # Lexers that come with Pygments are covered by its version
+        if lang not in self.lexer_versions:
+            version = None
+            lexer = lexer_classes.get(lang, None)
+            if lexer is not None:
+                if not isinstance(lexer, type):
+                    lexer = type(lexer)
+                version = hashlib.sha256(
+                    Path(inspect.getsourcefile(lexer)).read_bytes()).hexdigest()
+            self.lexer_versions[lang] = version
+        return self.lexer_versions[lang]
+
+    def key(self, bridge, source, lang, opts, force, kwargs):
+        style = bridge.formatter_args.get('style', None)
+        return hashlib.sha256(repr((
+            pygments.__version__, sphinx.__version__,
+            bridge.dest, bridge.formatter.__name__, getattr(style, '__name__', style),
+            lang, self.get_lexer_version(lang), sorted((opts or {}).items()), force,
+            sorted(kwargs.items()), source,
+        )).encode('utf-8')).digest()
+
+    def write(self, statement=None, params=()):
+        # Runs statement, if any, and saves the counts of this process
+        db = self.connect()
+        db.execute('BEGIN')
+        if statement is not None:
+            db.execute(statement, params)
+        db.execute('INSERT OR REPLACE INTO counts VALUES (?, ?, ?, ?, ?, ?)',
+            (self.build, self.pid, self.hits, self.misses, self.saved, self.spent))
+        db.execute('COMMIT')
+
+    def get(self, key):
+        entry = self.connect().execute(
+            'SELECT output, seconds FROM highlighted WHERE key = ?', (key,)).fetchone()
+        if entry is None:
+            return None
+        self.hits += 1
+        self.saved += entry[1]
+        self.write('UPDATE highlighted SET used = ? WHERE key = ?', (int(time.time()), key))
+        return entry[0]
+
+    def add(self, key, output, seconds):
+        self.misses += 1
+        self.spent += seconds
+        if key is None:
+            self.write()
+        else:
+            self.write('INSERT OR REPLACE INTO highlighted VALUES (?, ?, ?, ?)',
+                (key, output, seconds, int(time.time())))
+
+    def finish(self):
+        if self.db is None and not self.path.is_file():
+            return
+        db = self.connect()
+        hits, misses, saved, spent = db.execute(
+            'SELECT TOTAL(hits), TOTAL(misses), TOTAL(saved), TOTAL(spent) '
+            'FROM counts WHERE build = ?', (self.build,)).fetchone()
+        db.execute('BEGIN')
+        db.execute('DELETE FROM counts WHERE build = ?', (self.build,))
+        evicted = db.execute(
+            'DELETE FROM highlighted WHERE key IN ('
+                'SELECT key FROM ('
+                    'SELECT key, SUM(LENGTH(key) + LENGTH(CAST(output AS BLOB)) + 16) '
+                        'OVER (ORDER BY used DESC, key) AS total FROM highlighted) '
+                'WHERE total > ?)', (self.max_size,)).rowcount
+        db.execute('COMMIT')
+        if evicted:
+            db.execute('VACUUM')
+        db.close()
+        self.db = None
+        logger.info('highlight cache: {} hits, {} misses, {} evicted, '
+            '{:.2f}s saved, {:.2f}s highlighting'.format(
+                int(hits), int(misses), evicted, saved, spent))
+
+
+class CachingHighlighter:
+    # Stands in for the PygmentsBridge of the builder
+    def __init__(self, app, bridge, cache):
+        self.app = app
+        self.bridge = bridge
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self.bridge, name)
+
+    def highlight_block(self, source, lang, opts=None, force=False, location=None, **kwargs):
+        key = self.cache.key(self.bridge, source, lang, opts, force, kwargs)
+        output = self.cache.get(key)
+        if output is not None:
+            return output
+        warnings = getattr(self.app, '_warncount', 0)
+        start = time.perf_counter()
+        output = self.bridge.highlight_block(source, lang, opts, force, location, **kwargs)
+        seconds = time.perf_counter() - start
+        # Blocks that caused warnings, like ones the lexer couldn't handle,
+        # aren't cached so the warnings show up again on the next build.
+        if getattr(self.app, '_warncount', 0) != warnings:
+            key = None
+        self.cache.add(key, output, seconds)
+        return output
+
+
+def install_cache(app):
+    bridge = getattr(app.builder, 'highlighter', None)
+    if bridge is None or not app.config.highlight_cache_size:
+        return
+    cache = HighlightCache(Path(app.confdir) / app.config.highlight_cache_path,
+        app.config.highlight_cache_size * 1024 * 1024)
+    app.builder.highlighter = CachingHighlighter(app, bridge, cache)
+
+
+def finish_cache(app, exception):
+    highlighter = getattr(app.builder, 'highlighter', None)
+    if isinstance(highlighter, CachingHighlighter):
+        highlighter.cache.finish()
+
+
+def setup(app):
+    app.add_config_value('highlight_cache_path', '.convert_cache/highlight.sqlite', '')
+    app.add_config_value('highlight_cache_size', 32, '')
+
+    app.connect('builder-inited', install_cache)
+    app.connect('build-finished', finish_cache)
+
+    return {
+        'parallel_read_safe': True,
+        'parallel_write_safe': True,
+    }
@@ -0,0 +1,113 @@
+# Merging of inline monospace markup in RST output
+#
+# Inline monospace spans are converted separately, so the output ends up with
+# things like "``foo````bar``" or "word``foo``word". MonospaceFixer merges
+# adjacent spans and puts spaces between spans and words so that RST accepts
+# them. It is fed output in pieces and carries its state across them, so
+# markup split over several writes is handled the same as if it was written
+# all at once. Text without backticks or newlines is copied in bulk.
+
+import re
+
+
+class MonospaceFixer:
+  __slots__ = ('newlines', 'state', 'tick_count', 'keep_back', 'newline_count',
+    'last_char')
+
+  # newlines: If true, a newline ends any markup in progress and every third
+  # newline in a row is dropped. If false, newlines are treated like any other
+  # character.
+  def __init__(self, newlines=True, last_char=None):
+    self.newlines = newlines
+    self.state = 0 # 0 is left of ``..``, 1 is inside, 2 is after
+    self.tick_count = 0
+    self.keep_back = None
+    self.newline_count = 0
+    self.last_char = last_char
+
+  _token_re = re.compile(r'[^`\n]+|`|\n')
+  _token_no_newlines_re = re.compile(r'[^`]+|`')
+
+  def feed(self, raw_string):
+    parts = []
+    regex = self._token_re if self.newlines else self._token_no_newlines_re
+    for token in regex.findall(raw_string):
+      if token == '`':
+        self.newline_count = 0
+        if self.state == 0: # Left of ``..``
+          if self.tick_count == 1: # Almost Inside ``..``
+            if self.last_char is not None and self.last_char.isalnum():
+              parts.append(' ')
+            parts.append('``')
+            self.last_char = '`'
+            self.state = 1
+            self.tick_count = 0
+          else:
+            self.tick_count += 1
+        elif self.state == 1: # Inside ``..``
+          if self.tick_count == 1: # Almost Outside ``..``
+            self.keep_back = '``'
+            self.state = 2
+            self.tick_count = 0
+          else:
+            self.tick_count += 1
+        else: # After ``..``
+          if self.tick_count == 1: # Inside again, merge with the last ``..``
+            self.tick_count = 0
+            self.keep_back = None
+            self.state = 1
+          else:
+            self.tick_count += 1
+
+      elif token == '\n' and self.newlines:
+        self.flush_pending(parts)
+        self.state = 0
+        if self.newline_count == 2:
+          self.newline_count = 0
+        else:
+          self.newline_count += 1
+          parts.append('\n')
+          self.last_char = '\n'
+
+      else:
+        if self.state == 2: # After ``
+          parts.append(self.keep_back)
+          self.keep_back = None
+          first = token[0]
+          if first.isalnum():
+            parts.append(' ')
+          self.state = 0
+          # Like the rest of the characters, a tick left over from after ``
+          # only comes out in front of the next one.
+          parts.append(first)
+          token = token[1:]
+          if token:
+            self.flush_pending(parts)
+        else:
+          self.flush_pending(parts)
+        self.newline_count = 0
+        if token:
+          parts.append(token)
+        self.last_char = parts[-1][-1]
+
+    return ''.join(parts)
+
+  def flush_pending(self, parts):
+    if self.keep_back:
+      parts.append(self.keep_back)
+      self.keep_back = None
+      self.last_char = '`'
+    if self.tick_count:
+      parts.append('`' * self.tick_count)
+      self.tick_count = 0
+      self.last_char = '`'
+
+  def flush(self):
+    parts = []
+    self.flush_pending(parts)
+    return ''.join(parts)
+
+
+def fix_monospace(raw_string, last_char=None):
+  fixer = MonospaceFixer(newlines=False, last_char=last_char)
+  return fixer.feed(raw_string) + fixer.flush()
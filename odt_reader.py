@@ -0,0 +1,269 @@
+# Streaming alternative to odf.opendocument.load
+#
+# Reads the XML parts straight out of the ODT zip with expat and builds a slim
+# tree that has the parts of the odfpy node and document interfaces that
+# convert.py uses: qname, attributes, childNodes, nodeType, str() and toXml on
+# nodes, topnode, getStyleByName, getElementsByType and Pictures on the
+# document. Picture bytes are only read from the archive when asked for.
+#
+# The odfpy loader quirks the converter depends on are kept: attribute values
+# go through odfpy's attribute converters, only the same top level parts are
+# kept, adjacent text is merged into one text node, and duplicate style names
+# get renamed with an "M" prefix the same way.
+
+import zipfile
+import xml.parsers.expat
+from collections.abc import Mapping
+
+from odf import element
+from odf.element import _sanitize, _quoteattr
+from odf.attrconverters import AttrConverters, make_NCName
+from odf.namespaces import OFFICENS, STYLENS, TEXTNS
+from odf.odfmanifest import manifestlist
+
+
+class Text:
+  __slots__ = ('data', 'parentNode')
+  nodeType = element.Node.TEXT_NODE
+  attributes = None
+  childNodes = ()
+
+  def __init__(self, data):
+    self.data = data
+    self.parentNode = None
+
+  def __str__(self):
+    return self.data
+
+  def toXml(self, level, f):
+    if self.data:
+      f.write(_sanitize(self.data))
+
+
+class Element:
+  __slots__ = ('qname', 'tagName', 'attributes', 'childNodes', 'parentNode',
+    'opendds_section_id')
+  nodeType = element.Node.ELEMENT_NODE
+
+  # Share odfpy's namespace prefix table so toXml and the attribute converters
+  # behave the same as they do for odfpy elements.
+  namespaces = element.Element.namespaces
+  get_knownns = element.Element.get_knownns
+  get_nsprefix = element.Element.get_nsprefix
+
+  def __init__(self, qname, attributes=None):
+    self.qname = qname
+    self.tagName = self.get_nsprefix(qname[0]) + ':' + qname[1]
+    self.attributes = {}
+    self.childNodes = []
+    self.parentNode = None
+    if attributes:
+      for attr, value in attributes.items():
+        self.get_nsprefix(attr[0])
+        self.attributes[attr] = attr_converters.convert(attr, value, self)
+
+  def addElement(self, node):
+    node.parentNode = self
+    self.childNodes.append(node)
+
+  def __str__(self):
+    return ''.join([str(child) for child in self.childNodes])
+
+  def toXml(self, level, f):
+    f.write('<' + self.tagName)
+    if level == 0:
+      for namespace, prefix in self.namespaces.items():
+        f.write(' xmlns:' + prefix + '="' + _sanitize(str(namespace)) + '"')
+    for qname, value in self.attributes.items():
+      prefix = self.get_nsprefix(qname[0])
+      f.write(' ' + _sanitize(prefix + ':' + qname[1]) + '=' + _quoteattr(str(value)))
+    if self.childNodes:
+      f.write('>')
+      for child in self.childNodes:
+        child.toXml(level + 1, f)
+      f.write('</' + self.tagName + '>')
+    else:
+      f.write('/>')
+
+
+attr_converters = AttrConverters()
+
+
+def office(name):
+  return (OFFICENS, name)
+
+
+# Same as odf.load.LoadParser
+triggers = {
+  office('automatic-styles'), office('body'), office('font-face-decls'),
+  office('master-styles'), office('meta'), office('scripts'), office('settings'),
+  office('styles'),
+}
+
+
+class Pictures(Mapping):
+  # Mirrors OpenDocument.Pictures, but only reads a picture when it's accessed.
+  def __init__(self, path, media_types):
+    self.path = path
+    self.media_types = media_types
+
+  def __getitem__(self, name):
+    media_type = self.media_types[name]
+    with zipfile.ZipFile(self.path) as z:
+      return (1, z.read(name), media_type)
+
+  def __iter__(self):
+    return iter(self.media_types)
+
+  def __len__(self):
+    return len(self.media_types)
+
+
+class Document:
+  def __init__(self, path, mimetype):
+    self.path = path
+    self.mimetype = mimetype
+    self.styles_dict = {}
+    self.styles_ooo_fix = {}
+    self.Pictures = Pictures(path, {})
+
+    self.topnode = Element(office('document'), {
+      office('version'): '1.2',
+      office('mimetype'): mimetype,
+    })
+    self.meta = self.add_container('meta')
+    self.scripts = self.add_container('scripts')
+    self.fontfacedecls = self.add_container('font-face-decls')
+    self.settings = self.add_container('settings')
+    self.styles = self.add_container('styles')
+    self.automaticstyles = self.add_container('automatic-styles')
+    self.masterstyles = self.add_container('master-styles')
+    self.body = self.add_container('body')
+
+  def add_container(self, name):
+    node = Element(office(name))
+    self.topnode.addElement(node)
+    return node
+
+  def register(self, node):
+    # Same as OpenDocument.build_caches
+    if node.qname == (STYLENS, 'style'):
+      name = node.attributes.get((STYLENS, 'name'), None)
+      if name is not None and node.parentNode.qname in (office('styles'), office('automatic-styles')):
+        if name in self.styles_dict:
+          new_name = 'M' + name
+          self.styles_ooo_fix[name] = new_name
+          name = new_name
+          node.attributes[(STYLENS, 'name')] = name
+        self.styles_dict[name] = node
+    style_ref = node.attributes.get((TEXTNS, 'style-name'), None)
+    if style_ref is not None and style_ref in self.styles_ooo_fix:
+      node.attributes[(TEXTNS, 'style-name')] = self.styles_ooo_fix[style_ref]
+
+  def getStyleByName(self, name):
+    result = self.styles_dict.get(make_NCName(name), None)
+    assert isinstance(result, Element)
+    return result
+
+  def getElementsByType(self, elt):
+    qname = elt(check_grammar=False).qname
+    result = []
+    stack = [self.topnode]
+    while stack:
+      node = stack.pop()
+      if node.qname == qname:
+        result.append(node)
+      stack.extend(reversed(
+        [c for c in node.childNodes if c.nodeType == element.Node.ELEMENT_NODE]))
+    return result
+
+
+class PartParser:
+  def __init__(self, doc, part):
+    self.doc = doc
+    self.part = part
+    self.parse = False
+    self.stack = []
+    self.data = []
+    self.qnames = {}
+    self.containers = {
+      office('automatic-styles'): doc.automaticstyles,
+      office('body'): doc.body,
+      office('master-styles'): doc.masterstyles,
+      office('meta'): doc.meta,
+      office('scripts'): doc.scripts,
+      office('settings'): doc.settings,
+      office('styles'): doc.styles,
+    }
+    if part == 'styles.xml':
+      self.containers[office('font-face-decls')] = doc.fontfacedecls
+
+  def qname(self, name):
+    qname = self.qnames.get(name, None)
+    if qname is None:
+      ns, sep, local = name.rpartition(' ')
+      qname = (ns if sep else None, local)
+      self.qnames[name] = qname
+    return qname
+
+  def flush_text(self):
+    if self.data:
+      content = ''.join(self.data)
+      self.data = []
+      if content:
+        self.stack[-1].addElement(Text(content))
+
+  def start(self, name, attrs):
+    qname = self.qname(name)
+    if qname in triggers:
+      self.parse = True
+    if self.part != 'styles.xml' and qname == office('font-face-decls'):
+      self.parse = False
+    if not self.parse:
+      return
+    if self.stack:
+      self.flush_text()
+    node = self.containers.get(qname, None)
+    if node is None:
+      node = Element(qname, {self.qname(k): v for k, v in attrs.items()})
+      self.stack[-1].addElement(node)
+      self.doc.register(node)
+    self.stack.append(node)
+
+  def end(self, name):
+    if not self.parse:
+      return
+    self.flush_text()
+    self.stack.pop()
+    if self.qname(name) in triggers:
+      self.parse = False
+
+  def characters(self, data):
+    if self.parse:
+      self.data.append(data)
+
+  def run(self, f):
+    parser = xml.parsers.expat.ParserCreate(namespace_separator=' ')
+    parser.buffer_text = True
+    parser.StartElementHandler = self.start
+    parser.EndElementHandler = self.end
+    parser.CharacterDataHandler = self.characters
+    parser.ParseFile(f)
+
+
+def load(path):
+  with zipfile.ZipFile(path) as z:
+    try:
+      mimetype = z.read('mimetype').decode('utf-8')
+    except KeyError:
+      mimetype = 'application/vnd.oasis.opendocument.text'
+    doc = Document(path, mimetype)
+    manifest = manifestlist(z.read('META-INF/manifest.xml'))
+    for part in ('settings.xml', 'meta.xml', 'content.xml', 'styles.xml'):
+      if part in manifest:
+        with z.open(part) as f:
+          PartParser(doc, part).run(f)
+    for name, entry in manifest.items():
+      if name[:9] == 'Pictures/' and len(name) > 9:
+        doc.Pictures.media_types[entry['full-path']] = entry['media-type']
+  return doc